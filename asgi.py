@@ -0,0 +1,7 @@
+import config
+from common.asgi import AsgiApp
+from main import create_app
+
+# Entry point for ASGI servers: uvicorn asgi:app --workers 2
+# or gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app
+app = AsgiApp(create_app(), config.SERVER_THREADS)
@@ -0,0 +1,90 @@
+"""
+    Local stand-in for the Yandex notification API, records every state callback it gets.
+
+    python -m benchmarks.callback_stub --port 8081 --failure-rate 0.1
+
+    Then set YANDEX_CALLBACK_URL = "http://127.0.0.1:8081/callback/state" in config.py.
+"""
+import argparse
+import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class CallbackStub:
+    """ Answers 202 like Yandex, or 500 for failure_rate of the requests to exercise retries """
+
+    def __init__(self, port: int = 0, failure_rate: float = 0.0, verbose: bool = False):
+        self.failure_rate = failure_rate
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        # Bodies of accepted callbacks in arrival order
+        self.received = []
+        self.rejected = 0
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                if random.random() < stub.failure_rate:
+                    with stub.lock:
+                        stub.rejected += 1
+                    self.send_response(500)
+                    self.end_headers()
+                    return
+
+                with stub.lock:
+                    stub.received.append(body)
+                if stub.verbose:
+                    print(json.dumps(body, ensure_ascii=False), flush=True)
+
+                answer = json.dumps({"request_id": self.headers.get("X-Request-Id"), "status": "ok"}).encode()
+                self.send_response(202)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(answer)))
+                self.end_headers()
+                self.wfile.write(answer)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/callback/state"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="callback-stub", daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def last_values(self) -> dict[tuple[str, str, str], object]:
+        """ (device id, capability type, instance) -> value of the last accepted callback """
+        values = {}
+        with self.lock:
+            for body in self.received:
+                for device in body["payload"]["devices"]:
+                    for item in device.get("capabilities", []) + device.get("properties", []):
+                        values[(device["id"], item["type"], item["state"]["instance"])] = item["state"]["value"]
+
+        return values
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of callbacks answered with 500")
+    args = parser.parse_args()
+
+    stub = CallbackStub(args.port, args.failure_rate, verbose=True)
+    print(f"Listening on {stub.url}", flush=True)
+    stub.server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
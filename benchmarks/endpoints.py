@@ -0,0 +1,210 @@
+"""
+    Throughput and latency of the skill endpoints against a simulated Khawasu mesh.
+
+    python -m benchmarks.endpoints --devices 200 --latency 20 --jitter 10 --failure-rate 0.01 \\
+        --requests 500 --concurrency 16 --query-size 20
+
+    Runs in a temporary directory, config.py is only changed in memory.
+"""
+import argparse
+import itertools
+import os
+import random
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from benchmarks.callback_stub import CallbackStub
+from benchmarks.fake_driver import FakeLogicalDriver, FakeMesh
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLIENT_ID = "benchmark"
+CLIENT_SECRET = "benchmark-secret"
+USERNAME = "benchmark"
+PASSWORD = "benchmark"
+
+
+class Scenario:
+    def __init__(self, name: str, request):
+        self.name = name
+        self.request = request
+
+
+def percentile(samples: list[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+def run(scenario: Scenario, app, requests: int, concurrency: int):
+    local = threading.local()
+
+    def one(_):
+        if getattr(local, "client", None) is None:
+            local.client = app.test_client()
+
+        start = time.perf_counter()
+        ok = scenario.request(local.client)
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(one, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for latency, _ in results]
+    errors = sum(1 for _, ok in results if not ok)
+    print(f"{scenario.name:<10} {requests / elapsed:>9.1f} req/s   p50 {percentile(latencies, 0.5) * 1000:>8.2f} ms   "
+          f"p99 {percentile(latencies, 0.99) * 1000:>8.2f} ms   errors {errors}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=20, help="mesh round trip, milliseconds")
+    parser.add_argument("--jitter", type=float, default=10, help="milliseconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of mesh calls that time out")
+    parser.add_argument("--dead-devices", type=int, default=0, help="devices which never answer")
+    parser.add_argument("--gateways", type=int, default=1, help="devices are split evenly between gateways")
+    parser.add_argument("--requests", type=int, default=500, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--query-size", type=int, default=20, help="devices per query/action request")
+    parser.add_argument("--bcrypt-rounds", type=int, default=config.BCRYPT_ROUNDS)
+    parser.add_argument("--scenarios", default="oauth,devices,query,action,slider")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="khawasu-bench-")
+    config.DATABASE_PATH = os.path.join(workdir, "db.json")
+    config.TOKEN_STORE_PATH = os.path.join(workdir, "tokens.db")
+    config.TOKEN_JOURNAL_PATH = os.path.join(workdir, "tokens.jsonl")
+    config.DISCOVERY_SNAPSHOT_PATH = os.path.join(workdir, "discovery.json")
+    config.METRICS_DIR = os.path.join(workdir, "metrics")
+    config.MESH_OWNER_ADDRESS = os.path.join(workdir, "mesh.sock")
+    config.CLIENT_ID = CLIENT_ID
+    config.CLIENT_SECRET = CLIENT_SECRET
+    config.BCRYPT_ROUNDS = args.bcrypt_rounds
+    config.LOGIN_MAX_ATTEMPTS = args.requests + 1
+    config.YANDEX_CALLBACK_URL = ""
+    config.KHAWASU_DEBUG_MODE = False
+
+    # Asset paths are relative to the repository root
+    os.chdir(ROOT)
+
+    # Every gateway is a separate mesh, dead devices are taken from the first one
+    import common.khawasu
+    per_gateway = args.devices // args.gateways
+    meshes = [FakeMesh(per_gateway if i < args.gateways - 1 else args.devices - per_gateway * i,
+                       args.latency / 1000, args.jitter / 1000, args.failure_rate,
+                       dead_count=args.dead_devices if i == 0 else 0, first_index=per_gateway * i)
+              for i in range(args.gateways)]
+    config.KHAWASU_GATEWAYS = [("fake", port) for port in range(args.gateways)]
+    common.khawasu.create_driver = lambda addr, port: FakeLogicalDriver(meshes[port])
+
+    from common.token import Token
+    from common.user import User
+    from main import create_app
+
+    app = create_app()
+    User.create(USERNAME, PASSWORD)
+    headers = {"Authorization": f"Bearer {Token.generate(USERNAME, Token.TOKEN_ACCESS_DEFAULT_LENGTH).value}",
+               "X-Request-Id": "benchmark"}
+    addresses = [row["address"] for mesh in meshes for row in mesh.rows]
+
+    def oauth(client):
+        query = urllib.parse.urlencode({"state": "benchmark", "response_type": "code", "client_id": CLIENT_ID,
+                                        "redirect_uri": "https://example.invalid/callback"})
+        response = client.post(f"/auth/?{query}", data={"username": USERNAME, "password": PASSWORD})
+        if response.status_code != 302:
+            return False
+
+        code = urllib.parse.parse_qs(urllib.parse.urlparse(response.headers["Location"]).query)["code"][0]
+        response = client.post("/token/", data={"client_id": CLIENT_ID, "client_secret": CLIENT_SECRET, "code": code})
+        return response.status_code == 200
+
+    def devices(client):
+        return client.get("/v1.0/user/devices", headers=headers).status_code == 200
+
+    def query(client):
+        ids = random.sample(addresses, min(args.query_size, len(addresses)))
+        response = client.post("/v1.0/user/devices/query", headers=headers,
+                               json={"devices": [{"id": _id} for _id in ids]})
+        return response.status_code == 200 and all("error_code" not in device
+                                                   for device in response.get_json()["payload"]["devices"])
+
+    def action(client):
+        ids = random.sample(addresses, min(args.query_size, len(addresses)))
+        capability = {"type": "devices.capabilities.on_off", "state": {"instance": "on", "value": True}}
+        response = client.post("/v1.0/user/devices/action", headers=headers,
+                               json={"payload": {"devices": [{"id": _id, "capabilities": [capability]}
+                                                             for _id in ids]}})
+        return response.status_code == 200
+
+    # Brightness sliders dragged on a few lamps at once through ACTION_ASYNC_MODE, callbacks go to a local stub
+    dimmers = [row["address"] for mesh in meshes for row in mesh.rows if "brightness" in row["actions"]][:4]
+    slider_positions = itertools.count()
+
+    def slider(client):
+        capability = {"type": "devices.capabilities.range",
+                      "state": {"instance": "brightness", "value": next(slider_positions) % 101}}
+        response = client.post("/v1.0/user/devices/action", headers=headers,
+                               json={"payload": {"devices": [{"id": random.choice(dimmers),
+                                                              "capabilities": [capability]}]}})
+        return response.status_code == 200
+
+    def check_slider():
+        """ After the drag every lamp gets one more position: that must be the state reported and left in the mesh """
+        from common.action_queue import action_queue
+
+        client = app.test_client()
+        final = {address: random.randrange(101) for address in dimmers}
+        for address, value in final.items():
+            client.post("/v1.0/user/devices/action", headers=headers,
+                        json={"payload": {"devices": [{"id": address, "capabilities": [
+                            {"type": "devices.capabilities.range", "state": {"instance": "brightness",
+                                                                            "value": value}}]}]}})
+
+        while action_queue().pending or action_queue().running:
+            time.sleep(0.01)
+
+        reported = stub.last_values()
+        states = client.post("/v1.0/user/devices/query", headers=headers,
+                             json={"devices": [{"id": address} for address in dimmers]}).get_json()
+        stale = sum(1 for address, value in final.items()
+                    if reported.get((address, "devices.capabilities.range", "brightness")) != value)
+        stale += sum(1 for device in states["payload"]["devices"]
+                     for capability in device.get("capabilities", [])
+                     if capability["state"]["instance"] == "brightness"
+                     and abs(capability["state"]["value"] - final[device["id"]]) > 1)
+        print(f"{'':<10} {len(stub.received)} callbacks, {stale} stale final states")
+
+    scenarios = {"oauth": Scenario("oauth", oauth), "devices": Scenario("devices", devices),
+                 "query": Scenario("query", query), "action": Scenario("action", action),
+                 "slider": Scenario("slider", slider)}
+
+    print(f"{args.devices} devices, {args.latency:g}±{args.jitter:g} ms mesh latency, "
+          f"{args.failure_rate:.1%} failures, {args.dead_devices} dead, {args.gateways} gateways, "
+          f"{args.concurrency} concurrent clients")
+    for name in args.scenarios.split(","):
+        if name == "slider":
+            stub = CallbackStub()
+            stub.start()
+            config.ACTION_ASYNC_MODE, config.YANDEX_CALLBACK_URL = True, stub.url
+
+        run(scenarios[name], app, args.requests, args.concurrency)
+
+        if name == "slider":
+            check_slider()
+            config.ACTION_ASYNC_MODE, config.YANDEX_CALLBACK_URL = False, ""
+            stub.stop()
+
+    calls = {}
+    for mesh in meshes:
+        for method, count in mesh.calls.items():
+            calls[method] = calls.get(method, 0) + count
+    print("mesh calls:", ", ".join(f"{method} {count}" for method, count in sorted(calls.items())))
+
+
+if __name__ == "__main__":
+    main()
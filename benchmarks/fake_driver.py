@@ -0,0 +1,146 @@
+"""
+    Simulated Khawasu mesh speaking the LogicalDriver interface, for benchmarks without hardware.
+"""
+import heapq
+import itertools
+import random
+import threading
+import time
+import types
+
+ROW_TEMPLATES = [
+    (2, {"power": 2, "label": 4}),
+    (4, {"temperature": 5, "humidity": 6}),
+    (8, {"power": 2, "brightness": 3}),
+    (1, {"press": 1}),
+]
+
+
+def make_rows(device_count: int, rooms: int = 20, first_index: int = 0) -> list[dict]:
+    rows = []
+    for i in range(first_index, first_index + device_count):
+        dev_class, actions = ROW_TEMPLATES[i % len(ROW_TEMPLATES)]
+        rows.append({"address": f"{i:016x}", "attribs": {}, "dev_class": dev_class,
+                     "group_name": f"room {i % rooms}", "name": f"device {i}", "actions": dict(actions)})
+
+    return rows
+
+
+class FakeMesh:
+    """ Devices and their states shared by all fake connections """
+
+    def __init__(self, device_count: int, latency: float, jitter: float, failure_rate: float, rooms: int = 20,
+                 dead_count: int = 0, first_index: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.lock = threading.Lock()
+        self.calls = {}
+
+        self.rows = make_rows(device_count, rooms, first_index)
+        self.states = {(row["address"], action_name): bytes([random.randrange(256), random.randrange(256)])
+                       for row in self.rows for action_name in row["actions"]}
+        # Nodes which never answer
+        self.dead = {row["address"] for row in self.rows[:dead_count]}
+
+        # Answers waiting for their latency to pass: (due time, sequence, incoming packets dict, packet)
+        self.condition = threading.Condition()
+        self.in_flight = []
+        self.sequence = itertools.count()
+        self.subscription_ids = itertools.count(1)
+        threading.Thread(target=self.delivery_loop, name="fake-mesh", daemon=True).start()
+
+    def count(self, method_name: str):
+        with self.lock:
+            self.calls[method_name] = self.calls.get(method_name, 0) + 1
+
+    def round_trip(self, method_name: str):
+        self.count(method_name)
+
+        time.sleep(max(self.latency + random.uniform(-self.jitter, self.jitter), 0))
+
+        if random.random() < self.failure_rate:
+            raise IOError("Response timeout")
+
+    def answer(self, method_name: str, args: dict):
+        if method_name == "list-devices":
+            return [dict(row) for row in self.rows]
+
+        if method_name == "action_fetch":
+            state = self.states.get((args["address"], args["action_name"]))
+            return {"status": "no-such-action"} if state is None else {"data": state}
+
+        if method_name == "action_subscribe_new":
+            return {"id": next(self.subscription_ids)}
+
+        return {}
+
+    def deliver_later(self, incoming_packets: dict, packet: dict):
+        # A failed call is never answered, like a node which dropped off the mesh
+        if random.random() < self.failure_rate:
+            return
+
+        due = time.monotonic() + max(self.latency + random.uniform(-self.jitter, self.jitter), 0)
+        with self.condition:
+            heapq.heappush(self.in_flight, (due, next(self.sequence), incoming_packets, packet))
+            self.condition.notify()
+
+    def delivery_loop(self):
+        while True:
+            with self.condition:
+                while not self.in_flight or self.in_flight[0][0] > time.monotonic():
+                    self.condition.wait(self.in_flight[0][0] - time.monotonic() if self.in_flight else None)
+
+                _, _, incoming_packets, packet = heapq.heappop(self.in_flight)
+
+            incoming_packets[packet["id"]] = packet
+
+
+class FakeLogicalDriver:
+    """ Requests are answered by id through incoming_packets like the real driver, see khawasu_stuff.transport """
+
+    def __init__(self, mesh: FakeMesh):
+        self.mesh = mesh
+        self.DEBUG_MODE = False
+        self.version = 0
+        self.subscribes = {}
+        self.sock = types.SimpleNamespace(close=lambda: None)
+        self.sem_idx = threading.Semaphore(value=1)
+        self.idx_buf = 0
+        self.incoming_packets = {}
+
+    def send(self, method_name, args=None, id=0):
+        self.mesh.count(method_name)
+        if id != 0 and (args or {}).get("address") not in self.mesh.dead:
+            self.mesh.deliver_later(self.incoming_packets,
+                                    {"id": id, "method": method_name, "data": self.mesh.answer(method_name, args or {})})
+
+    def get(self, method_name, args=None):
+        if args is None:
+            args = {}
+
+        self.mesh.round_trip(method_name)
+
+        if method_name == "action_subscribe_new":
+            subscription_id = len(self.subscribes) + 1
+            return {"id": subscription_id}
+
+        return self.mesh.answer(method_name, args)
+
+    def execute(self, address, method_name, row_data: bytes):
+        # LogicalDriver.execute only queues the packet, it does not wait for the mesh
+        with self.mesh.lock:
+            self.mesh.calls["action"] = self.mesh.calls.get("action", 0) + 1
+        self.mesh.states[(address, method_name)] = row_data
+
+    def action_get(self, address, method_name):
+        return self.get("action_fetch", {"action_name": method_name, "address": address})
+
+    def subscribe(self, address, method_name, period, duration, handler):
+        try:
+            answ = self.get("action_subscribe_new", {"address": address, "action_name": method_name,
+                                                     "period": period, "duration": duration})
+        except IOError:
+            return {"data": {"status": "socket-error"}, "method": "action_subscribe_new"}
+
+        self.subscribes[int(answ["id"])] = (address, method_name, handler)
@@ -0,0 +1,48 @@
+"""
+    Memory taken by the discovery cache: Khawasu devices plus their Yandex views for a synthetic mesh.
+
+    python -m benchmarks.memory --devices 5000
+"""
+import argparse
+import gc
+import tracemalloc
+
+import khawasu_stuff.device
+from benchmarks.fake_driver import make_rows
+from common.device import Device, get_capability_templates, get_yandex_device_param_map
+
+
+def measure(count: int) -> int:
+    # Asset maps and templates are loaded once per process, keep them out of the numbers
+    get_yandex_device_param_map()
+    get_capability_templates()
+
+    rows = make_rows(count)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+
+    khawasu_devices = [khawasu_stuff.device.Device(row, None) for row in rows]
+    devices = [Device.from_khawasu_device(dev) for dev in khawasu_devices]
+
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    total = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del devices, khawasu_devices
+
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=5000)
+    args = parser.parse_args()
+
+    total = measure(args.devices)
+    print(f"{args.devices} devices: {total / 1024:.0f} KiB total, {total / args.devices:.0f} bytes per device")
+
+
+if __name__ == "__main__":
+    main()
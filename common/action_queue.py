@@ -0,0 +1,116 @@
+import logging
+import threading
+from collections import OrderedDict
+
+import config
+from common.callback import send_state
+from common.device import Device
+
+log = logging.getLogger(__name__)
+
+_action_queue = None
+_action_queue_lock = threading.Lock()
+
+
+class ActionQueue:
+    """
+        Capability changes waiting to be sent to the mesh. Keys are (device id, capability type, instance),
+        a newer value for a pending key replaces the older one, so only the last slider position goes out.
+        A key is not taken by a worker while another one still sends it, so values of a key go out in order.
+    """
+
+    def __init__(self, workers: int):
+        self.condition = threading.Condition()
+        self.pending = OrderedDict()
+        # Keys being sent right now
+        self.running = set()
+        self.workers = [threading.Thread(target=self.worker_loop, name=f"action-queue-{i}", daemon=True)
+                        for i in range(workers)]
+
+        for worker in self.workers:
+            worker.start()
+
+    def put(self, user_id: str, device_id: str, cap: dict):
+        with self.condition:
+            self.pending[(device_id, cap["type"], cap["state"]["instance"])] = (user_id, cap)
+            self.condition.notify()
+
+    def submit_many(self, user_id: str, devices: list[dict]) -> list[dict]:
+        # Check what can be checked without the mesh, acknowledge the rest immediately
+        results = []
+        for device in devices:
+            device_obj = Device.get_for_user(device['id'], user_id)
+            if device_obj is None:
+                results.append({'id': device['id'], 'action_result': Device.get_action_result_object(
+                    "DEVICE_NOT_FOUND", "Device not found")})
+                continue
+
+            result = {'id': device['id'], 'capabilities': []}
+            for cap in device['capabilities']:
+                error_code, error_message = "", ""
+                if device_obj.get_most_similar_cap_action(cap) is None:
+                    error_code, error_message = "INVALID_ACTION", f"Capability {cap['type']} is not supported"
+                else:
+                    self.put(user_id, device['id'], cap)
+
+                result['capabilities'].append({
+                    'type': cap["type"],
+                    'state': {
+                        "instance": cap["state"]["instance"],
+                        "action_result": Device.get_action_result_object(error_code, error_message)
+                    }
+                })
+
+            results.append(result)
+
+        return results
+
+    def next_key(self) -> tuple | None:
+        # Called with self.condition held
+        return next((key for key in self.pending if key not in self.running), None)
+
+    def worker_loop(self):
+        while True:
+            with self.condition:
+                while (key := self.next_key()) is None:
+                    self.condition.wait()
+                user_id, cap = self.pending.pop(key)
+                self.running.add(key)
+
+            try:
+                self.process(user_id, key[0], cap)
+            except Exception:
+                log.exception("Error in queued action", extra={"device_id": key[0]})
+            finally:
+                with self.condition:
+                    self.running.discard(key)
+                    # A newer value came in meanwhile and waited for this one
+                    if key in self.pending:
+                        self.condition.notify()
+
+    def process(self, user_id: str, device_id: str, cap: dict):
+        device = Device.get_by_id(device_id)
+        if device is None or device.khawasu_device is None:
+            return
+
+        result = device.execute_capabilities(device.khawasu_device, [cap])
+        if result['capabilities'][0]['state']['action_result']['status'] != "DONE":
+            log.warning("Queued action failed: %s", result['capabilities'][0]['state']['action_result'],
+                        extra={"device_id": device_id})
+            return
+
+        send_state(user_id, [{'id': device_id, 'capabilities': [{
+            'type': cap["type"],
+            'state': {"instance": cap["state"]["instance"], "value": cap["state"]["value"]}
+        }]}])
+
+
+def action_queue() -> ActionQueue:
+    global _action_queue
+    if _action_queue is None:
+        # The first requests come in together, two queues would send values of one key side by side
+        with _action_queue_lock:
+            if _action_queue is None:
+                _action_queue = ActionQueue(config.ACTION_QUEUE_WORKERS)
+
+    return _action_queue
@@ -0,0 +1,148 @@
+import asyncio
+import json
+import logging
+import time
+
+from flask import Flask
+from uvicorn.middleware.wsgi import WSGIMiddleware
+
+import config
+from common import runtime
+from common.action_queue import action_queue
+from common.auth import authenticate, parse_bearer
+from common.device import Device
+from common.metrics import metrics
+from common.principal import principal_cache
+from common.registry import registry
+
+log = logging.getLogger(__name__)
+
+request_seconds = metrics().histogram("http_request_seconds", "Duration of API requests", ("method", "route"))
+requests_total = metrics().counter("http_requests_total", "API responses by status", ("method", "route", "status"))
+
+
+class Request:
+    __slots__ = ("method", "path", "headers", "body")
+
+    def __init__(self, method: str, path: str, headers: dict, body: bytes):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+    def get_json(self):
+        return json.loads(self.body)
+
+
+class AsgiApp:
+    """
+        Serves /devices/query and /devices/action on the event loop: requests waiting for the mesh hold no thread.
+        Every other route goes to the Flask app in a thread pool, answers have the same format in both paths.
+        Run with an ASGI server, see asgi.py.
+    """
+
+    def __init__(self, flask_app: Flask, threads: int):
+        self.flask_app = flask_app
+        self.wsgi_app = WSGIMiddleware(flask_app, workers=threads)
+        self.routes = {
+            ("POST", "/v1.0/user/devices/query"): self.query,
+            ("POST", "/v1.0/user/devices/action"): self.action,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+
+        if scope["type"] == "websocket":
+            # Closing before the handshake is accepted rejects the connection with 403
+            await receive()
+            return await send({"type": "websocket.close"})
+
+        if scope["type"] != "http":
+            raise NotImplementedError(f"Unsupported ASGI scope type: {scope['type']}")
+
+        view = self.routes.get((scope["method"], scope["path"]))
+        if view is None:
+            return await self.wsgi_app(scope, receive, send)
+
+        status, headers, chunks = await self.call_view(view, scope, await self.read_body(receive))
+
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": b"".join(chunks)})
+
+    @staticmethod
+    async def lifespan(receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                runtime.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    @staticmethod
+    async def read_body(receive) -> bytes:
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                return b"".join(chunks)
+
+    async def call_view(self, view, scope, body: bytes):
+        start = time.perf_counter()
+        headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+        request = Request(scope["method"], scope["path"], headers, body)
+
+        try:
+            status, content_type, data = await self.authorized(view, request)
+        except Exception as ex:
+            log.exception("Error in %s", request.path)
+            status, content_type, data = 500, "text/html; charset=utf-8", f"Error {type(ex).__name__}: {str(ex)}"
+
+        request_seconds.observe(time.perf_counter() - start, request.method, request.path)
+        requests_total.inc(request.method, request.path, str(status))
+
+        data = data.encode()
+        return status, [(b"content-type", content_type.encode()), (b"content-length", str(len(data)).encode())], [data]
+
+    async def authorized(self, view, request: Request):
+        # Same checks as login_required, the token store is only asked (in a thread) on a principal cache miss
+        value = parse_bearer(request.headers.get("authorization"))
+        entry = principal_cache().get(value) if value is not None else None
+        access_token, user = entry if entry is not None else await asyncio.to_thread(authenticate, value)
+
+        if access_token is None:
+            return 403, "text/html; charset=utf-8", "Error: Token not exists"
+        if user is None:
+            return 403, "text/html; charset=utf-8", "Error: User not exists"
+
+        result = await view(request, user)
+
+        # Same serialization as jsonify
+        response = self.flask_app.json.response(result)
+        return response.status_code, response.content_type, response.get_data(as_text=True)
+
+    @staticmethod
+    async def query(request: Request, user) -> dict:
+        r = request.get_json()
+
+        # Waits only while the registry was never filled, see Device.refresh_if_stale
+        if not registry().loaded or registry().needs_discovery(config.DISCOVERY_TTL, config.DISCOVERY_RETRY_INTERVAL):
+            await asyncio.to_thread(Device.refresh_if_stale)
+
+        devices = await Device.query_many_async([device['id'] for device in r["devices"]], user.username)
+        return {'request_id': request.headers.get('x-request-id'), 'payload': {'devices': devices}}
+
+    @staticmethod
+    async def action(request: Request, user) -> dict:
+        r = request.get_json()
+
+        # Executes are only queued in the driver, this does not wait for the mesh
+        if config.ACTION_ASYNC_MODE:
+            devices = await asyncio.to_thread(action_queue().submit_many, user.username, r["payload"]["devices"])
+        else:
+            devices = await asyncio.to_thread(Device.action_many, r["payload"]["devices"], user.username)
+
+        return {'request_id': request.headers.get('x-request-id'), 'payload': {'devices': devices}}
@@ -0,0 +1,68 @@
+import functools
+import logging
+
+from flask import g, request
+
+from common.principal import principal_cache
+from common.token import Token
+from common.user import User
+
+log = logging.getLogger(__name__)
+
+
+def parse_bearer(auth: str | None):
+    if auth is None:
+        return None
+
+    parts = auth.split(' ', 2)
+    if len(parts) == 2 and parts[0].lower() == 'bearer':
+        return parts[1]
+    else:
+        log.info("Invalid Authorization header")
+        return None
+
+
+# Function to retrieve token from header
+def get_token():
+    return parse_bearer(request.headers.get('Authorization'))
+
+
+def authenticate(value: str):
+    if value is None:
+        return None, None
+
+    entry = principal_cache().get(value)
+    if entry is not None:
+        return entry
+
+    access_token = Token.get_by_value(value)
+    if access_token is None:
+        return None, None
+
+    user = User.get_by_username(access_token.username)
+    if user is not None:
+        principal_cache().put(value, access_token, user)
+
+    return access_token, user
+
+
+# Resolves bearer token into g.access_token and g.user, optionally requiring an existing user
+def login_required(require_user: bool = True):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            access_token, user = authenticate(get_token())
+            if access_token is None:
+                return f"Error: Token not exists", 403
+
+            if require_user and user is None:
+                return f"Error: User not exists", 403
+
+            g.access_token = access_token
+            g.user = user
+
+            return view(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,33 @@
+import logging
+import time
+
+import requests
+
+import config
+
+log = logging.getLogger(__name__)
+
+
+def state_reporting_enabled() -> bool:
+    """ Reports need the state cache to see changes and a callback URL to send them to """
+    return config.STATE_REPORTING_ENABLED and config.STATE_CACHE_ENABLED and bool(config.YANDEX_CALLBACK_URL)
+
+
+def send_state(user_id: str, devices: list[dict]) -> bool:
+    """
+        Pushes device states to the Yandex notification API (or any stub at YANDEX_CALLBACK_URL).
+        devices is a list of {'id': ..., 'capabilities': [...], 'properties': [...]} like in /devices/query
+    """
+    if not config.YANDEX_CALLBACK_URL:
+        return False
+
+    url = config.YANDEX_CALLBACK_URL.format(skill_id=config.YANDEX_SKILL_ID)
+    body = {"ts": time.time(), "payload": {"user_id": user_id, "devices": devices}}
+
+    response = requests.post(url, json=body, timeout=config.YANDEX_CALLBACK_TIMEOUT,
+                             headers={"Authorization": f"OAuth {config.YANDEX_OAUTH_TOKEN}"})
+    if response.status_code != 202 and response.status_code != 200:
+        log.warning("Callback rejected: %s", response.text, extra={"status": response.status_code})
+        return False
+
+    return True
@@ -1,13 +1,62 @@
+import threading
+
 from tinydb import TinyDB, Query
+from tinydb.storages import JSONStorage
+from tinydb.table import Table
 
 import config
+from common.metrics import metrics
 
 _db = None
 
+_operation_seconds = metrics().histogram("tinydb_operation_seconds", "Duration of TinyDB file reads and writes, "
+                                         "including the wait for the storage lock", ("operation",))
+
+
+class LockedJSONStorage(JSONStorage):
+    # TinyDB reads and writes through one shared file handle, concurrent request threads must take turns
+    lock = threading.RLock()
+
+    def read(self):
+        with _operation_seconds.time("read"), self.lock:
+            return super().read()
+
+    def write(self, data):
+        with _operation_seconds.time("write"), self.lock:
+            super().write(data)
+
+
+class LockedTable(Table):
+    """
+        Holds the storage lock for a whole table change: TinyDB reads the file, changes the table and writes it back,
+        two threads doing that side by side would each write their own copy and the first change would be lost
+    """
+
+    def _update_table(self, updater):
+        with LockedJSONStorage.lock:
+            super()._update_table(updater)
+
+    # These pick the next document id (or search) before the change and must not interleave with another insert
+    def insert(self, document):
+        with LockedJSONStorage.lock:
+            return super().insert(document)
+
+    def insert_multiple(self, documents):
+        with LockedJSONStorage.lock:
+            return super().insert_multiple(documents)
+
+    def upsert(self, document, cond=None):
+        with LockedJSONStorage.lock:
+            return super().upsert(document, cond)
+
+
+class LockedTinyDB(TinyDB):
+    table_class = LockedTable
+
 
 def db() -> TinyDB:
     global _db
     if _db is None:
-        _db = TinyDB(config.DATABASE_PATH)
+        _db = LockedTinyDB(config.DATABASE_PATH, storage=LockedJSONStorage)
 
     return _db
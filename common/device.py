@@ -1,15 +1,30 @@
 from __future__ import annotations
 
+import asyncio
 import json
+import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 
+import config
 from khawasu_stuff.action import ActionType
+from khawasu_stuff.breaker import CircuitOpenError
 from khawasu_stuff.device import DeviceType
 import khawasu_stuff
-from common.khawasu import driver
+from common.callback import state_reporting_enabled
+from common.executor import action_executor, query_executor
+from common.khawasu import driver_pools
+from common.mesh import mesh_client
+from common.ownership import ownership
+from common.registry import registry
+from common.snapshot import load_snapshot, save_snapshot
+from common.state import state_cache
+
+log = logging.getLogger(__name__)
 
-_devices = []
 _yandex_device_param_map = None
 _yandex_device_type_map = None
+_capability_templates = None
 
 
 def get_yandex_device_param_map() -> dict:
@@ -30,7 +45,38 @@ def get_yandex_device_type_map() -> dict:
     return _yandex_device_type_map
 
 
+def get_capability_templates() -> dict:
+    """ ActionType -> (section, capability template) built once from the type map, section is "capabilities" or
+        "properties". Ignored types and types missing in the map have no template. """
+    global _capability_templates
+    if _capability_templates is None:
+        templates = {}
+        for action_type in ActionType:
+            if action_type in Device.IGNORE_TYPES or action_type.name not in get_yandex_device_type_map():
+                continue
+
+            yandex_type = get_yandex_device_type_map()[action_type.name]
+            templates[action_type] = (
+                "properties" if yandex_type["type"].startswith("devices.properties.") else "capabilities",
+                {
+                    "type": yandex_type["type"],
+                    "parameters": yandex_type["parameters"] | Device.PARAMETER_OVERRIDES.get(action_type, {}),
+                    "retrievable": True,
+                    "reportable": state_reporting_enabled()
+                })
+
+        _capability_templates = templates
+
+    return _capability_templates
+
+
 class Device:
+    """
+        A device as Yandex sees it.
+        items - (section, khawasu action name, capability template) for every capability and property,
+        templates are shared between devices and Yandex dicts are only built when asked for
+    """
+
     DEFAULT_MANUFACTURER = "Khawasu chan"
     DEFAULT_MODEL = 0
     DEFAULT_HARDWARE_VERSION = 1.0
@@ -38,29 +84,66 @@ class Device:
 
     IGNORE_TYPES = [ActionType.UNKNOWN, ActionType.IMMEDIATE, ActionType.LABEL]
 
-    def __init__(self, _id: str, name: str, description: str, room: str, type: str, capabilities=None, properties=None,
-                 device_info=None):
-        if capabilities is None:
-            capabilities = []
-        if properties is None:
-            properties = []
-
-        if device_info is None:
-            device_info = {
-                "manufacturer": self.DEFAULT_MANUFACTURER,
-                "model": str(self.DEFAULT_MODEL),
-                "hw_version": str(self.DEFAULT_HARDWARE_VERSION),
-                "sw_version": str(self.DEFAULT_SOFTWARE_VERSION)
+    PARAMETER_OVERRIDES = {
+        ActionType.RANGE: {
+            "instance": "brightness",
+            "unit": "unit.percent",
+            "range": {
+                "min": 0,
+                "max": 100
             }
+        },
+        ActionType.TEMPERATURE: {
+            "instance": "temperature",
+            "unit": "unit.temperature.celsius"
+        },
+        ActionType.HUMIDITY: {
+            "instance": "humidity",
+            "unit": "unit.percent"
+        }
+    }
+
+    DEFAULT_DEVICE_INFO = {
+        "manufacturer": DEFAULT_MANUFACTURER,
+        "model": str(DEFAULT_MODEL),
+        "hw_version": str(DEFAULT_HARDWARE_VERSION),
+        "sw_version": str(DEFAULT_SOFTWARE_VERSION)
+    }
 
+    __slots__ = ("id", "name", "description", "room", "type", "items", "device_info", "khawasu_device",
+                 "items_by_action", "capabilities_by_type", "serialized")
+
+    def __init__(self, _id: str, name: str, description: str, room: str, type: str, items=(), device_info=None,
+                 khawasu_device: khawasu_stuff.device.Device = None):
         self.id = _id
         self.name = name
         self.description = description
         self.room = room
         self.type = type
-        self.capabilities = capabilities
-        self.properties = properties
-        self.device_info = device_info
+        self.items = tuple(items)
+        self.device_info = self.DEFAULT_DEVICE_INFO if device_info is None else device_info
+        self.khawasu_device = khawasu_device
+        self.serialized = None
+
+        self.items_by_action = {action_name: (section, template) for section, action_name, template in self.items}
+
+        # First capability of each type wins, like the old linear search did
+        self.capabilities_by_type = {}
+        for section, action_name, template in self.items:
+            if section == "capabilities":
+                self.capabilities_by_type.setdefault(template["type"], action_name)
+
+    def get_items(self, section: str) -> list[dict]:
+        return [template | {"__khawasu_action": action_name} for item_section, action_name, template in self.items
+                if item_section == section]
+
+    @property
+    def capabilities(self) -> list[dict]:
+        return self.get_items("capabilities")
+
+    @property
+    def properties(self) -> list[dict]:
+        return self.get_items("properties")
 
     def get_row_object(self):
         return {
@@ -74,148 +157,454 @@ class Device:
             "device_info": self.device_info,
         }
 
-    def query(self) -> dict:
-        khawasu_device = khawasu_stuff.device.Device.get_by_address(driver(), self.id)
-        result = {'id': self.id, 'capabilities': [], 'properties': []}
-
-        if khawasu_device is None:
-            return []
-
-        for cap in self.capabilities:
-            if not cap.get("retrievable", True):
-                continue
-
-            current_state = khawasu_device.get(cap["__khawasu_action"])
+    def get_serialized(self) -> bytes:
+        # Devices are rebuilt when they change, so the encoded row object stays valid for the object's lifetime
+        if self.serialized is None:
+            self.serialized = json.dumps(self.get_row_object(), separators=(",", ":")).encode()
 
-            result['capabilities'].append({
-                'type': cap["type"],
-                'state': {
-                    "instance": cap["parameters"]["instance"],
-                    "value": current_state
-                }
-            })
-
-        for prop in self.properties:
-            if not prop.get("retrievable", True):
-                continue
+        return self.serialized
 
-            current_state = khawasu_device.get(prop["__khawasu_action"])
+    def get_retrievable(self) -> list[tuple[str, str, dict]]:
+        return [item for item in self.items if item[2].get("retrievable", True)]
 
-            result['properties'].append({
-                'type': prop["type"],
-                'state': {
-                    "instance": prop["parameters"]["instance"],
-                    "value": current_state
-                }
-            })
+    def query(self) -> dict:
+        return self.query_many([self.id])[0]
 
-        return result
+    @staticmethod
+    def get_error_object(_id: str, error_code: str, error_message: str) -> dict:
+        return {'id': _id, 'error_code': error_code, 'error_message': error_message}
 
     def get_most_similar_cap_action(self, cap_row) -> str | None:
-        for cap in self.capabilities:
-            if cap["type"] == cap_row["type"]:
-                return cap["__khawasu_action"]
+        return self.capabilities_by_type.get(cap_row["type"])
 
-        return None
+    @staticmethod
+    def get_action_result_object(error_code: str = "", error_message: str = "") -> dict:
+        return {
+            "status": "ERROR" if error_code else "DONE",
+            "error_code": error_code,
+            "error_message": error_message
+        }
 
     def action(self, capabilities):
-        khawasu_device = khawasu_stuff.device.Device.get_by_address(driver(), self.id)
+        return self.action_many([{'id': self.id, 'capabilities': capabilities}])[0]
+
+    def execute_capabilities(self, khawasu_device: khawasu_stuff.device.Device, capabilities,
+                             deadline: float = None) -> dict:
+        """
+            Capabilities still unsent at deadline (time.monotonic()) are dropped instead of reaching the device after
+            the caller reported DEVICE_UNREACHABLE. One already being sent can not be called back and may still land.
+        """
         result = {'id': self.id, 'capabilities': []}
 
-        if khawasu_device is None:
-            return []
-
         for cap in capabilities:
-            new_value = cap["state"]["value"]
+            error_code, error_message = "", ""
             similar_action = self.get_most_similar_cap_action(cap)
 
-            if similar_action is None:
-                continue
-
-            khawasu_device.execute(similar_action, new_value)
+            try:
+                if deadline is not None and time.monotonic() > deadline:
+                    error_code, error_message = "DEVICE_UNREACHABLE", "Device did not answer in time"
+                elif similar_action is None or not self.execute_action(khawasu_device, similar_action,
+                                                                     cap["state"]["value"]):
+                    error_code, error_message = "INVALID_ACTION", f"Capability {cap['type']} is not supported"
+            except CircuitOpenError as ex:
+                error_code, error_message = "DEVICE_UNREACHABLE", str(ex)
+            except Exception as ex:
+                log.warning("Error in action execute: %r", ex, extra={"device_id": self.id})
+                error_code, error_message = "DEVICE_UNREACHABLE", str(ex)
 
             result['capabilities'].append({
                 'type': cap["type"],
                 'state': {
                     "instance": cap["state"]["instance"],
-                    "action_result": {
-                        "status": "DONE",
-                        "error_code": "",  # todo implement error handling
-                        "error_message": ""
-                    }
+                    "action_result": self.get_action_result_object(error_code, error_message)
                 }
             })
 
         return result
 
+    @staticmethod
+    def execute_action(khawasu_device: khawasu_stuff.device.Device, action_name: str, value) -> bool:
+        client = mesh_client()
+        if client is not None:
+            return client.call("execute", khawasu_device.address, action_name, value).result(
+                timeout=config.ACTION_DEADLINE)
+
+        if not khawasu_device.execute(action_name, value):
+            return False
+
+        state_cache().invalidate(khawasu_device.address, action_name)
+        return True
+
     @classmethod
-    def get_capability(cls, khawasu_action: khawasu_stuff.action.Action):
-        cap = {
-            "type": get_yandex_device_type_map()[khawasu_action.type.name]["type"],
-            "parameters": {},
-            "retrievable": True,
-            "reportable": False,
-            "__khawasu_action": khawasu_action.name
-        }
+    def from_khawasu_device(cls, khawasu_device: khawasu_stuff.device.Device):
+        templates = get_capability_templates()
+        return cls(khawasu_device.address,
+                   khawasu_device.name,
+                   get_yandex_device_param_map()[khawasu_device.type.name]["desc"],
+                   khawasu_device.group,
+                   get_yandex_device_param_map()[khawasu_device.type.name]["type"],
+                   [(templates[action.type][0], action.name, templates[action.type][1])
+                    for action in khawasu_device.actions if action.type in templates],
+                   khawasu_device=khawasu_device)
+
+    @classmethod
+    def read_state(cls, khawasu_device: khawasu_stuff.device.Device, action_name: str) -> Future:
+        # The owner answers from its state cache or asks the mesh
+        client = mesh_client()
+        if client is not None:
+            return client.call("read", khawasu_device.address, action_name)
 
-        cap["parameters"] = cap["parameters"] | get_yandex_device_type_map()[khawasu_action.type.name]["parameters"]
+        if config.STATE_CACHE_ENABLED:
+            value = state_cache().get(khawasu_device.address, action_name, config.STATE_MAX_STALENESS)
+            if value is not None:
+                future = Future()
+                future.set_result(value)
+                return future
 
-        if khawasu_action.type == ActionType.RANGE:
-            cap["parameters"]["instance"] = "brightness"
-            cap["parameters"]["unit"] = "unit.percent"
-            cap["parameters"]["range"] = {
-                "min": 0,
-                "max": 100
-            }
-        if khawasu_action.type == ActionType.TEMPERATURE:
-            cap["parameters"]["instance"] = "temperature"
-            cap["parameters"]["unit"] = "unit.temperature.celsius"
+        return query_executor().submit(state_cache().fetch, khawasu_device, action_name)
+
+    @classmethod
+    def read_state_async(cls, khawasu_device: khawasu_stuff.device.Device, action_name: str) -> asyncio.Future:
+        client = mesh_client()
+        if client is not None:
+            return asyncio.wrap_future(client.call("read", khawasu_device.address, action_name))
+
+        if config.STATE_CACHE_ENABLED:
+            value = state_cache().get(khawasu_device.address, action_name, config.STATE_MAX_STALENESS)
+            if value is not None:
+                future = asyncio.get_running_loop().create_future()
+                future.set_result(value)
+                return future
 
-        if khawasu_action.type == ActionType.HUMIDITY:
-            cap["parameters"]["instance"] = "humidity"
-            cap["parameters"]["unit"] = "unit.percent"
+        return asyncio.ensure_future(state_cache().fetch_async(khawasu_device, action_name))
 
-        return cap
+    @classmethod
+    def find_for_user(cls, ids: list[str], username: str = None) -> list[Device | None]:
+        return [cls.get_for_user(_id, username) for _id in ids]
 
     @classmethod
-    def is_capability(cls, khawasu_action):
-        return khawasu_action.type not in cls.IGNORE_TYPES and \
-               get_yandex_device_type_map()[khawasu_action.type.name]["type"].find(
-                   "properties") == -1  # todo: replace find to beautiful way
+    def plan_query(cls, ids: list[str], devices: list[Device | None], read_state) -> list[tuple]:
+        # Every action_get of every device is started at once
+        planned = []
+        for _id, device in zip(ids, devices):
+            khawasu_device = device.khawasu_device if device else None
+
+            reads = []
+            if khawasu_device is not None:
+                for section, action_name, item in device.get_retrievable():
+                    reads.append((section, action_name, item, read_state(khawasu_device, action_name)))
+
+            planned.append((_id, device, khawasu_device, reads))
+
+        return planned
 
     @classmethod
-    def is_property(cls, khawasu_action):
-        return khawasu_action.type not in cls.IGNORE_TYPES and \
-               get_yandex_device_type_map()[khawasu_action.type.name]["type"].find("properties") != -1
+    def query_many(cls, ids: list[str], username: str = None) -> list[dict]:
+        # Fire every action_get of every device at once, then collect whatever finished before the deadline
+        planned = cls.plan_query(ids, cls.find_for_user(ids, username), cls.read_state)
+
+        futures = [future for *_, reads in planned for *_, future in reads]
+        _, not_done = wait(futures, timeout=config.QUERY_DEADLINE)
+        for future in not_done:
+            future.cancel()
+
+        return cls.collect_query(planned)
 
     @classmethod
-    def from_khawasu_device(cls, khawasu_device: khawasu_stuff.device.Device):
-        return cls(khawasu_device.address,
-                   khawasu_device.name,
-                   get_yandex_device_param_map()[khawasu_device.type.name]["desc"],
-                   khawasu_device.group,
-                   get_yandex_device_param_map()[khawasu_device.type.name]["type"],
-                   [cls.get_capability(action) for action in khawasu_device.actions if
-                    cls.is_capability(action)],
-                   [cls.get_capability(action) for action in khawasu_device.actions if
-                    cls.is_property(action)])
+    async def query_many_async(cls, ids: list[str], username: str = None) -> list[dict]:
+        """ query_many for the event loop, reads wait for the mesh without holding threads """
+        # Ownership may be reloaded from the database, that must not stop the event loop
+        devices = await asyncio.to_thread(cls.find_for_user, ids, username)
+        planned = cls.plan_query(ids, devices, cls.read_state_async)
+
+        futures = [future for *_, reads in planned for *_, future in reads]
+        if futures:
+            done, not_done = await asyncio.wait(futures, timeout=config.QUERY_DEADLINE)
+            for future in not_done:
+                future.cancel()
+            # collect_query stops at the first failed read of a device, asyncio would log the other errors as lost
+            for future in done:
+                future.exception()
+
+        return cls.collect_query(planned)
 
     @classmethod
-    def get_by_id(cls, id: str) -> Device | None:
-        global _devices
+    def collect_query(cls, planned: list[tuple]) -> list[dict]:
+        """ Works with concurrent and asyncio futures alike """
+        results = []
+        for _id, device, khawasu_device, reads in planned:
+            if device is None:
+                results.append(cls.get_error_object(_id, "DEVICE_NOT_FOUND", "Device not found"))
+                continue
+
+            result = {'id': _id, 'capabilities': [], 'properties': []}
+
+            for section, action_name, item, future in reads:
+                current_state, error_message = None, f"No answer for {action_name}"
+                if future.done() and not future.cancelled():
+                    if future.exception() is None:
+                        current_state = future.result()
+                    elif isinstance(future.exception(), CircuitOpenError):
+                        error_message = str(future.exception())
+                    else:
+                        log.warning("Error in action fetch: %r", future.exception(), extra={"device_id": _id})
+
+                if current_state is None:
+                    result = cls.get_error_object(_id, "DEVICE_UNREACHABLE", error_message)
+                    break
+
+                result[section].append({
+                    'type': item["type"],
+                    'state': {
+                        "instance": item["parameters"]["instance"],
+                        "value": current_state
+                    }
+                })
+
+            if khawasu_device is None:
+                result = cls.get_error_object(_id, "DEVICE_UNREACHABLE", "Device is not in Khawasu network")
+
+            results.append(result)
+
+        return results
 
-        if len(_devices) == 0:
-            cls.get_all()
+    @classmethod
+    def action_many(cls, devices: list[dict], username: str = None) -> list[dict]:
+        # All capabilities of one device go out in a single task, devices are dispatched in parallel
+        capabilities_by_id = {}
+        for device in devices:
+            capabilities_by_id.setdefault(device['id'], []).extend(device['capabilities'])
+
+        deadline = time.monotonic() + config.ACTION_DEADLINE
+        planned = []
+        for _id, capabilities in capabilities_by_id.items():
+            device = cls.get_for_user(_id, username)
+            khawasu_device = device.khawasu_device if device else None
+
+            future = None
+            if khawasu_device is not None:
+                future = action_executor().submit(device.execute_capabilities, khawasu_device, capabilities,
+                                                  deadline)
+
+            planned.append((_id, device, future))
+
+        _, not_done = wait([future for *_, future in planned if future is not None], timeout=config.ACTION_DEADLINE)
+        for future in not_done:
+            future.cancel()
+
+        results = []
+        for _id, device, future in planned:
+            if device is None:
+                error_code, error_message = "DEVICE_NOT_FOUND", "Device not found"
+            elif future is None:
+                error_code, error_message = "DEVICE_UNREACHABLE", "Device is not in Khawasu network"
+            elif not future.done() or future.cancelled():
+                error_code, error_message = "DEVICE_UNREACHABLE", "Device did not answer in time"
+            elif future.exception() is not None:
+                # A malformed capability fails its device only, not the whole request
+                log.warning("Error in action: %r", future.exception(), extra={"device_id": _id})
+                error_code, error_message = "INTERNAL_ERROR", str(future.exception())
+            else:
+                results.append(future.result())
+                continue
 
-        for dev in _devices:
-            if dev.id == id:
-                return dev
+            results.append({'id': _id, 'action_result': cls.get_action_result_object(error_code, error_message)})
 
-        return None
+        return results
+
+    @classmethod
+    def plan_room_action(cls, room: str, capabilities: list[dict], device_type: str = None,
+                         username: str = None) -> list[dict]:
+        """
+            Action payload for every device of the room which supports all the capabilities
+            (and is of device_type if given), so "turn everything off" skips the sensors.
+        """
+        cap_types = {cap["type"] for cap in capabilities}
+        return [{'id': dev.id, 'capabilities': capabilities} for dev in cls.get_room(room, username)
+                if (device_type is None or dev.type == device_type) and cap_types <= dev.capabilities_by_type.keys()]
+
+    @staticmethod
+    def summarize_action_results(room: str, results: list[dict]) -> dict:
+        failed = [result['id'] for result in results
+                  if result.get('action_result', {}).get('status', "DONE") != "DONE"
+                  or any(cap['state']['action_result']['status'] != "DONE" for cap in result.get('capabilities', []))]
+
+        return {'room': room, 'total': len(results), 'done': len(results) - len(failed), 'failed': failed,
+                'devices': results}
+
+    @classmethod
+    def action_room(cls, room: str, capabilities: list[dict], device_type: str = None, username: str = None) -> dict:
+        """ Executes the capabilities on the whole room at once, results are aggregated per device """
+        planned = cls.plan_room_action(room, capabilities, device_type, username)
+        return cls.summarize_action_results(room, cls.action_many(planned, username))
+
+    @classmethod
+    def refresh_if_stale(cls):
+        """
+            Request path: only a process without any devices yet waits for discovery. A stale registry is served
+            as it is and refreshed by one background thread, a failed discovery is not retried before
+            DISCOVERY_RETRY_INTERVAL.
+        """
+        if not registry().loaded:
+            # Nothing to serve yet: wait for the discovery running now, or run one
+            cls.refresh()
+        elif registry().needs_discovery(config.DISCOVERY_TTL, config.DISCOVERY_RETRY_INTERVAL):
+            registry().refresh_in_background(cls.refresh)
+
+    @classmethod
+    def get_by_id(cls, id: str) -> Device | None:
+        cls.refresh_if_stale()
+
+        return registry().get(id)
 
     @classmethod
     def get_all(cls) -> list[Device]:
-        global _devices
-        _devices = [cls.from_khawasu_device(device) for device in khawasu_stuff.device.Device.get_all(driver())]
+        cls.refresh_if_stale()
+
+        return registry().all()
+
+    @classmethod
+    def get_for_user(cls, id: str, username: str = None) -> Device | None:
+        """ Like get_by_id, but devices the user does not own are not found (with DEVICE_OWNERSHIP_ENABLED) """
+        device = cls.get_by_id(id)
+        if device is None or username is None or not config.DEVICE_OWNERSHIP_ENABLED:
+            return device
+
+        return device if ownership().owns(username, device) else None
+
+    @classmethod
+    def get_room(cls, room: str, username: str = None) -> list[Device]:
+        cls.refresh_if_stale()
+
+        if username is None or not config.DEVICE_OWNERSHIP_ENABLED:
+            return registry().get_room(room)
+
+        devices = (registry().get(_id) for _id in ownership().projection(username).rooms.get(room, ()))
+        return [dev for dev in devices if dev is not None]
+
+    @classmethod
+    def get_rooms(cls, username: str = None) -> dict[str, list[str]]:
+        cls.refresh_if_stale()
+
+        if username is None or not config.DEVICE_OWNERSHIP_ENABLED:
+            return {room: list(addresses) for room, addresses in registry().rooms.items()}
+
+        return ownership().projection(username).rooms
+
+    @classmethod
+    def get_all_row_objects(cls) -> list[dict]:
+        cls.refresh_if_stale()
 
-        return _devices
+        return registry().get_row_objects()
+
+    @classmethod
+    def get_all_serialized(cls, username: str = None) -> tuple[bytes, str]:
+        cls.refresh_if_stale()
+
+        if username is None or not config.DEVICE_OWNERSHIP_ENABLED:
+            return registry().get_serialized_row_objects()
+
+        projection = ownership().projection(username)
+        return projection.serialized, projection.etag
+
+    @staticmethod
+    def discover() -> list[khawasu_stuff.device.Device]:
+        """
+            Device lists of all gateways, fetched in parallel. A gateway which fails keeps the devices it had,
+            only a failure of every gateway is raised. An address found on several gateways is routed
+            to the first of them in KHAWASU_GATEWAYS.
+        """
+        pools = driver_pools()
+        with ThreadPoolExecutor(max_workers=len(pools), thread_name_prefix="discovery") as discovery_executor:
+            futures = [discovery_executor.submit(khawasu_stuff.device.Device.get_all, pool) for pool in pools]
+
+        devices, errors = {}, []
+        for pool, future in zip(pools, futures):
+            if future.exception() is not None:
+                log.warning("Error in discovery: %r", future.exception(), extra={"gateway": pool.name})
+                errors.append(future.exception())
+
+            for khawasu_device in future.result() if future.exception() is None else pool.devices.values():
+                if devices.setdefault(khawasu_device.address, khawasu_device) is not khawasu_device:
+                    log.warning("Device is found on several gateways", extra={"address": khawasu_device.address,
+                                                                             "gateway": pool.name})
+
+        if len(errors) == len(pools):
+            raise errors[0]
+
+        return list(devices.values())
+
+    @staticmethod
+    def copy_devices(rows: list[dict] | None) -> list[khawasu_stuff.device.Device]:
+        """
+            Devices of the rows the mesh owner sent, None means its registry did not change. Devices without
+            a pool here, their reads and executes are sent to the owner.
+        """
+        previous = {dev.id: dev.khawasu_device for dev in registry().all()}
+        if rows is None:
+            return list(previous.values())
+
+        return [previous[row["address"]] if row["address"] in previous and previous[row["address"]].matches(row)
+                else khawasu_stuff.device.Device(row, None) for row in rows]
+
+    @classmethod
+    def refresh(cls, force: bool = False, direct: bool = False):
+        """ direct asks the mesh even while there is a mesh owner to copy from, see runtime.rediscover """
+        with registry().discovery_lock:
+            # Someone else could have refreshed (or failed to) while we were waiting
+            if not force and not registry().needs_discovery(config.DISCOVERY_TTL, config.DISCOVERY_RETRY_INTERVAL):
+                return
+
+            registry().last_attempt = time.time()
+
+            if mesh_client() is not None and not direct:
+                rows = mesh_client().fetch_devices(config.KHAWASU_DISCOVERY_TIMEOUT)
+                registry().update(cls.copy_devices(rows), cls.from_khawasu_device)
+                return
+
+            changed = registry().update(cls.discover(), cls.from_khawasu_device)
+            if changed:
+                save_snapshot({pool.name: [dev.to_row() for dev in pool.devices.values()] for pool in driver_pools()})
+
+        if changed:
+            cls.track_states()
+
+    @classmethod
+    def track_states(cls):
+        # Only the mesh owner subscribes
+        if config.STATE_CACHE_ENABLED and mesh_client() is None:
+            state_cache().track({(dev.id, action_name): dev.khawasu_device
+                                 for dev in registry().all() for _, action_name, _ in dev.get_retrievable()})
+
+    @classmethod
+    def load_snapshot(cls) -> bool:
+        """
+            Fills the registry from the discovery snapshot so requests right after a restart need no mesh round trip.
+            Returns False if there is no usable snapshot.
+        """
+        rows_by_gateway = load_snapshot()
+        if rows_by_gateway is None:
+            return False
+
+        khawasu_devices = {}
+        for pool in driver_pools():
+            pool.devices = {row["address"]: khawasu_stuff.device.Device(row, pool)
+                            for row in rows_by_gateway.get(pool.name, ())}
+            for khawasu_device in pool.devices.values():
+                khawasu_devices.setdefault(khawasu_device.address, khawasu_device)
+
+        with registry().discovery_lock:
+            # A discovery which finished meanwhile is newer
+            if registry().loaded:
+                return True
+
+            registry().update(list(khawasu_devices.values()), cls.from_khawasu_device)
+
+        cls.track_states()
+        return True
+
+    @classmethod
+    def start_refresher(cls):
+        # Devices served from a snapshot are checked against the mesh right away, other workers copy the owner's
+        registry().start_refresher(config.DISCOVERY_REFRESH_INTERVAL, lambda: cls.refresh(force=True),
+                                   immediately=registry().loaded or mesh_client() is not None)
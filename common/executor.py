@@ -0,0 +1,22 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+
+_query_executor = None
+_action_executor = None
+
+
+def query_executor() -> ThreadPoolExecutor:
+    global _query_executor
+    if _query_executor is None:
+        _query_executor = ThreadPoolExecutor(max_workers=config.QUERY_MAX_WORKERS, thread_name_prefix="query")
+
+    return _query_executor
+
+
+def action_executor() -> ThreadPoolExecutor:
+    global _action_executor
+    if _action_executor is None:
+        _action_executor = ThreadPoolExecutor(max_workers=config.ACTION_MAX_WORKERS, thread_name_prefix="action")
+
+    return _action_executor
@@ -1,14 +1,59 @@
-from tinydb import TinyDB, Query
+import functools
+
 import config
 from driver_khawasu.driver import LogicalDriver
 
-_khawasu_driver = None
+from common.metrics import metrics
+from khawasu_stuff.pool import DriverPool
+
+_khawasu_driver_pools = None
+
+_call_seconds = metrics().histogram("khawasu_call_seconds", "Duration of LogicalDriver calls",
+                                    ("gateway", "call", "device_type", "action_type"))
+_call_errors = metrics().counter("khawasu_call_errors_total", "LogicalDriver calls which raised",
+                                 ("gateway", "call", "device_type", "action_type"))
+
+
+def observe_call(gateway: str, call: str, device_type: str, action_type: str, seconds: float, ok: bool):
+    _call_seconds.observe(seconds, gateway, call, device_type, action_type)
+    if not ok:
+        _call_errors.inc(gateway, call, device_type, action_type)
+
+
+def create_driver(addr: str = None, port: int = None) -> LogicalDriver:
+    khawasu_driver = LogicalDriver(config.KHAWASU_ADDR if addr is None else addr,
+                                   config.KHAWASU_PORT if port is None else port)
+    khawasu_driver.DEBUG_MODE = config.KHAWASU_DEBUG_MODE
+
+    return khawasu_driver
+
+
+def create_driver_pool(addr: str, port: int) -> DriverPool:
+    pool = DriverPool(functools.partial(create_driver, addr, port), config.KHAWASU_POOL_SIZE,
+                      config.KHAWASU_RECONNECT_BACKOFF, config.KHAWASU_RECONNECT_BACKOFF_MAX,
+                      config.KHAWASU_REQUEST_TIMEOUT, config.KHAWASU_DISCOVERY_TIMEOUT, name=f"{addr}:{port}",
+                      action_get_ttl=config.KHAWASU_ACTION_GET_TTL, circuit_failures=config.KHAWASU_CIRCUIT_FAILURES,
+                      circuit_open_seconds=config.KHAWASU_CIRCUIT_OPEN_SECONDS)
+    if config.METRICS_ENABLED:
+        pool.observer = functools.partial(observe_call, pool.name)
+
+    return pool
+
+
+def driver_pools() -> list[DriverPool]:
+    """ One pool per gateway of KHAWASU_GATEWAYS """
+    global _khawasu_driver_pools
+    if _khawasu_driver_pools is None:
+        _khawasu_driver_pools = [create_driver_pool(addr, port) for addr, port in config.KHAWASU_GATEWAYS]
+
+    return _khawasu_driver_pools
 
 
-def driver() -> LogicalDriver:
-    global _khawasu_driver
-    if _khawasu_driver is None:
-        _khawasu_driver = LogicalDriver(config.KHAWASU_ADDR, config.KHAWASU_PORT)
-        _khawasu_driver.DEBUG_MODE = config.KHAWASU_DEBUG_MODE
+def close_driver_pools():
+    global _khawasu_driver_pools
+    if _khawasu_driver_pools is None:
+        return
 
-    return _khawasu_driver
+    for pool in _khawasu_driver_pools:
+        pool.close()
+    _khawasu_driver_pools = None
@@ -0,0 +1,78 @@
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+import config
+
+_listener = None
+
+# Attributes every LogRecord has, anything else was passed through extra= and is logged as a field
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+
+def _record_fields(record: logging.LogRecord) -> dict:
+    fields = {
+        "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+        "level": record.levelname.lower(),
+        "logger": record.name,
+        "msg": record.getMessage(),
+    }
+    fields.update({key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES})
+
+    if record.exc_info:
+        fields["exc"] = logging.Formatter().formatException(record.exc_info)
+
+    return fields
+
+
+class KeyValueFormatter(logging.Formatter):
+    """ ts=... level=info logger=common.device msg="..." key=value """
+
+    def format(self, record: logging.LogRecord) -> str:
+        parts = []
+        for key, value in _record_fields(record).items():
+            value = str(value)
+            if not value or any(char in value for char in ' "=\n'):
+                value = json.dumps(value, ensure_ascii=False)
+            parts.append(f"{key}={value}")
+
+        return " ".join(parts)
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(_record_fields(record), ensure_ascii=False, default=str)
+
+
+def setup_logging():
+    """
+        Request threads only put records into a queue, a listener thread formats and writes them,
+        so a slow stderr never blocks a request. Calling it again does nothing.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JSONFormatter() if config.LOG_FORMAT == "json" else KeyValueFormatter())
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(config.LOG_LEVEL)
+    root.addHandler(logging.handlers.QueueHandler(records))
+
+    _listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging():
+    """ Writes out buffered records """
+    global _listener
+    if _listener is None:
+        return
+
+    _listener.stop()
+    _listener = None
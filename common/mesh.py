@@ -0,0 +1,398 @@
+import functools
+import logging
+import os
+import queue
+import secrets
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from multiprocessing.connection import Client, Listener
+
+import config
+
+log = logging.getLogger(__name__)
+
+_mesh_lock_file = None
+_mesh_owner = None
+_mesh_client = None
+_on_promoted = None
+_rediscover = None
+_handlers = None
+
+
+def mesh_address() -> str:
+    """
+        Path of the owner socket. A bare file name is put in a directory only this user can enter
+        ($XDG_RUNTIME_DIR/khawasu, else khawasu-<uid> in the temp directory), so other local users can not connect.
+        The directory of an explicit path must belong to this user (or root) and not be writable by others.
+    """
+    if os.path.dirname(config.MESH_OWNER_ADDRESS):
+        check_directory(os.path.dirname(config.MESH_OWNER_ADDRESS), (os.getuid(), 0), 0o022)
+        return config.MESH_OWNER_ADDRESS
+
+    base = os.environ.get("XDG_RUNTIME_DIR")
+    directory = os.path.join(base, "khawasu") if base else os.path.join(tempfile.gettempdir(), f"khawasu-{os.getuid()}")
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    # A directory created by someone else (or opened up later) in a shared temp directory is not trusted
+    check_directory(directory, (os.getuid(),), 0o077)
+
+    return os.path.join(directory, config.MESH_OWNER_ADDRESS)
+
+
+def check_directory(directory: str, owners: tuple, forbidden_mode: int):
+    info = os.stat(directory)
+    if info.st_uid not in owners or info.st_mode & forbidden_mode:
+        raise PermissionError(f"{directory} must belong to this user and not be open to others "
+                              f"(mode {0o777 & ~forbidden_mode:o} at most)")
+
+
+def mesh_authkey() -> bytes:
+    """
+        Random key both ends prove they know before anything is unpickled. The first worker writes it to a file
+        only this user can read next to the socket, the others read it from there.
+    """
+    path = f"{mesh_address()}.key"
+    if not os.path.exists(path):
+        # Written under another name first, so nobody reads a half written key
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(secrets.token_bytes(32))
+            os.link(temp_path, path)
+        except FileExistsError:
+            # Another worker was first
+            pass
+        finally:
+            os.unlink(temp_path)
+
+    info = os.stat(path)
+    if info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise PermissionError(f"{path} must belong to this user and be private (mode 600)")
+
+    with open(path, "rb") as file:
+        return file.read()
+
+
+class MeshOwner:
+    """
+        Serves the other worker processes: a request (request_id, method, args) is answered with
+        (request_id, ok, result) where result is handlers[method](*args) or the exception it raised.
+        A handler may return a concurrent future, it is answered once the future is done.
+    """
+
+    def __init__(self, address: str, handlers: dict, authkey: bytes):
+        self.address = address
+        self.handlers = handlers
+        self.authkey = authkey
+        self.listener = None
+
+    def start(self):
+        # We hold the owner lock, so a socket file left here belongs to a dead owner
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+
+        # The socket file is created private instead of being open until a chmod after bind
+        umask = os.umask(0o177)
+        try:
+            self.listener = Listener(self.address, family="AF_UNIX", authkey=self.authkey)
+        finally:
+            os.umask(umask)
+        threading.Thread(target=self.accept_loop, name="mesh-owner", daemon=True).start()
+
+    def accept_loop(self):
+        while True:
+            try:
+                connection = self.listener.accept()
+            except Exception as ex:
+                if self.listener is None:
+                    return
+
+                # Failed the authkey challenge or hung up during it
+                log.warning("Error in mesh connection: %r", ex)
+                continue
+
+            threading.Thread(target=self.serve, args=(connection,), name="mesh-owner-conn", daemon=True).start()
+
+    def serve(self, connection):
+        send_lock = threading.Lock()
+        try:
+            while True:
+                request_id, method, args = connection.recv()
+                try:
+                    result = self.handlers[method](*args)
+                except Exception as ex:
+                    self.reply(connection, send_lock, request_id, False, ex)
+                    continue
+
+                if isinstance(result, Future):
+                    result.add_done_callback(functools.partial(self.reply_future, connection, send_lock, request_id))
+                else:
+                    self.reply(connection, send_lock, request_id, True, result)
+        except (EOFError, OSError):
+            pass
+        finally:
+            connection.close()
+
+    @classmethod
+    def reply_future(cls, connection, send_lock: threading.Lock, request_id: int, future: Future):
+        if future.cancelled():
+            cls.reply(connection, send_lock, request_id, False, ConnectionError("Cancelled by the mesh owner"))
+        elif future.exception() is not None:
+            cls.reply(connection, send_lock, request_id, False, future.exception())
+        else:
+            cls.reply(connection, send_lock, request_id, True, future.result())
+
+    @staticmethod
+    def reply(connection, send_lock: threading.Lock, request_id: int, ok: bool, result):
+        with send_lock:
+            try:
+                connection.send((request_id, ok, result))
+            except (OSError, EOFError):
+                # The worker is gone
+                pass
+            except Exception:
+                # Pickling failed before anything was written
+                connection.send((request_id, False, RuntimeError(repr(result))))
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+
+
+class MeshClient:
+    """
+        Connection of a worker process to the mesh owner. Calls of all threads share one socket: the writer thread
+        sends them and the reader thread resolves their concurrent futures with the answers. If the owner goes away
+        the pending calls fail and this process tries to take over its role.
+    """
+
+    RECONNECT_DELAY = 0.2
+
+    def __init__(self, address: str, authkey: bytes):
+        self.address = address
+        self.authkey = authkey
+        self.lock = threading.Lock()
+        self.connection = None
+        self.next_id = 0
+        self.pending = {}
+        # (connection, request) waiting for the writer thread
+        self.outgoing = queue.SimpleQueue()
+        self.closed = False
+        # What the owner answered the last device list with, so an unchanged list is not sent again
+        self.registry_key = None
+
+    def connect(self) -> bool:
+        try:
+            connection = Client(self.address, family="AF_UNIX", authkey=self.authkey)
+        except OSError:
+            return False
+        except Exception as ex:
+            log.warning("Error in mesh connect: %r", ex)
+            return False
+
+        with self.lock:
+            self.connection = connection
+
+        return True
+
+    def start(self):
+        threading.Thread(target=self.read_loop, name="mesh-client", daemon=True).start()
+        threading.Thread(target=self.write_loop, name="mesh-client-writer", daemon=True).start()
+
+    def call(self, method: str, *args) -> Future:
+        """ Never blocks on the owner (safe on the event loop), the future fails at once while there is no connection """
+        future = Future()
+        with self.lock:
+            if self.connection is None:
+                future.set_exception(ConnectionError("Mesh owner is not connected"))
+                return future
+
+            self.next_id += 1
+            self.pending[self.next_id] = future
+            self.outgoing.put((self.connection, (self.next_id, method, args)))
+
+        return future
+
+    def fetch_devices(self, timeout: float) -> list[dict] | None:
+        """ Device rows of the owner's registry, None if they did not change since the last call """
+        key, rows = self.call("devices", self.registry_key).result(timeout=timeout)
+        if rows is not None:
+            self.registry_key = key
+
+        return rows
+
+    def write_loop(self):
+        while not self.closed:
+            item = self.outgoing.get()
+            if item is None:
+                return
+
+            connection, request = item
+            # Calls made on a connection which is gone were failed by read_loop, the next owner must not get them
+            if connection is not self.connection:
+                continue
+
+            try:
+                connection.send(request)
+            except Exception as ex:
+                future = self.pending.pop(request[0], None)
+                if future is not None:
+                    try:
+                        future.set_exception(ConnectionError(f"Mesh owner is not connected: {ex!r}"))
+                    except InvalidStateError:
+                        pass
+
+    def read_loop(self):
+        while not self.closed:
+            connection = self.connection
+            while connection is not None:
+                try:
+                    request_id, ok, result = connection.recv()
+                except (EOFError, OSError) as ex:
+                    if not self.closed:
+                        log.warning("Mesh owner connection lost: %r", ex)
+                    break
+                except Exception:
+                    log.exception("Error in mesh owner answer")
+                    continue
+
+                future = self.pending.pop(request_id, None)
+                if future is None:
+                    continue
+
+                try:
+                    if ok:
+                        future.set_result(result)
+                    else:
+                        future.set_exception(result)
+                except InvalidStateError:
+                    # Cancelled after its deadline
+                    pass
+
+            with self.lock:
+                if connection is not None:
+                    connection.close()
+                self.connection = None
+                pending, self.pending = self.pending, {}
+
+            for future in pending.values():
+                try:
+                    future.set_exception(ConnectionError("Mesh owner connection lost"))
+                except InvalidStateError:
+                    pass
+
+            # Either another worker owns the mesh again (maybe already restarted) or this one takes over
+            while not self.closed:
+                if take_over():
+                    return
+                if self.connect():
+                    break
+                time.sleep(self.RECONNECT_DELAY)
+
+    def close(self):
+        self.closed = True
+        self.outgoing.put(None)
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+
+
+def claim() -> bool:
+    """ True if this process owns the mesh: it holds the owner lock or there is no MESH_OWNER_ADDRESS """
+    global _mesh_lock_file
+    if not config.MESH_OWNER_ADDRESS or _mesh_lock_file is not None:
+        return True
+
+    # POSIX only, like the Unix socket itself
+    import fcntl
+
+    lock_file = open(f"{mesh_address()}.lock", "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return False
+
+    _mesh_lock_file = lock_file
+    return True
+
+
+def release_claim():
+    global _mesh_lock_file
+    if _mesh_lock_file is not None:
+        _mesh_lock_file.close()
+        _mesh_lock_file = None
+
+
+def start_mesh(handlers: dict, rediscover, on_promoted):
+    """
+        Serves handlers to the other workers if this process owns the mesh (see claim), else connects to the owner.
+        When the owner went away this process takes over: rediscover() finds the devices on the mesh itself
+        while calls still go to the (gone) owner and fail, only if it succeeds this process becomes the owner
+        and on_promoted() is called before serving starts.
+    """
+    global _mesh_owner, _mesh_client, _on_promoted, _rediscover, _handlers
+    if not config.MESH_OWNER_ADDRESS:
+        return
+
+    _handlers, _rediscover, _on_promoted = handlers, rediscover, on_promoted
+    if claim():
+        _mesh_owner = MeshOwner(mesh_address(), handlers, mesh_authkey())
+        _mesh_owner.start()
+        log.info("Serving the mesh to other workers", extra={"address": mesh_address()})
+        return
+
+    client = MeshClient(mesh_address(), mesh_authkey())
+    # The owner may have just taken the lock and not be listening yet
+    deadline = time.monotonic() + config.MESH_OWNER_CONNECT_TIMEOUT
+    while not client.connect() and time.monotonic() < deadline:
+        time.sleep(client.RECONNECT_DELAY)
+
+    _mesh_client = client
+    client.start()
+
+
+def take_over() -> bool:
+    global _mesh_owner, _mesh_client
+    if not claim():
+        return False
+
+    log.info("Mesh owner is gone, taking over", extra={"address": mesh_address()})
+    try:
+        _rediscover()
+    except Exception as ex:
+        # Still a client without an owner: calls fail with ConnectionError until this or another worker takes over
+        log.warning("Error in mesh takeover: %r", ex)
+        release_claim()
+        return False
+
+    _mesh_client = None
+    try:
+        _on_promoted()
+    except Exception:
+        log.exception("Error in mesh takeover")
+
+    _mesh_owner = MeshOwner(mesh_address(), _handlers, mesh_authkey())
+    _mesh_owner.start()
+    return True
+
+
+def mesh_client() -> MeshClient | None:
+    """ Connection to the worker owning the mesh, None in the owner itself (and without MESH_OWNER_ADDRESS) """
+    return _mesh_client
+
+
+def close_mesh():
+    global _mesh_owner, _mesh_client
+    if _mesh_client is not None:
+        _mesh_client.close()
+        _mesh_client = None
+
+    if _mesh_owner is not None:
+        _mesh_owner.close()
+        _mesh_owner = None
+
+    release_claim()
@@ -0,0 +1,240 @@
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+_metrics = None
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple, values: tuple, le: str = None) -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if le is not None:
+        parts.append(f'le="{le}"')
+
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, label_names: tuple = ()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, *labels, amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def family(self) -> dict:
+        with self.lock:
+            samples = [[list(labels), value] for labels, value in self.values.items()]
+
+        return {"type": "counter", "help": self.help, "label_names": list(self.label_names), "samples": samples}
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, label_names: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # labels -> [count per bucket (last one is above all bounds), sum, count]
+        self.values = {}
+
+    def observe(self, value: float, *labels):
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0, 0]
+
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def family(self) -> dict:
+        with self.lock:
+            samples = [[list(labels), [list(counts), total, count]] for labels, (counts, total, count)
+                       in self.values.items()]
+
+        return {"type": "histogram", "help": self.help, "label_names": list(self.label_names),
+                "buckets": list(self.buckets), "samples": samples}
+
+
+class Gauge:
+    """
+        Value read when metrics are rendered: collect() returns {label values tuple: value}.
+        kind is "counter" for totals kept by other objects (cache hits and such).
+    """
+
+    def __init__(self, name: str, help: str, collect, label_names: tuple = (), kind: str = "gauge"):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.label_names = label_names
+        self.kind = kind
+
+    def family(self) -> dict:
+        return {"type": self.kind, "help": self.help, "label_names": list(self.label_names),
+                "samples": [[list(labels), value] for labels, value in self.collect().items()]}
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = {}
+
+    def _register(self, item):
+        with self.lock:
+            return self.items.setdefault(item.name, item)
+
+    def counter(self, name: str, help: str, label_names: tuple = ()) -> Counter:
+        return self._register(Counter(name, help, label_names))
+
+    def histogram(self, name: str, help: str, label_names: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, label_names, buckets))
+
+    def gauge(self, name: str, help: str, collect, label_names: tuple = (), kind: str = "gauge") -> Gauge:
+        return self._register(Gauge(name, help, collect, label_names, kind))
+
+    def families(self) -> dict:
+        return {item.name: item.family() for item in list(self.items.values())}
+
+    def dump(self, directory: str):
+        """ Leaves the values of this process in directory for render of another worker to add up """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{os.getpid()}.json")
+        with open(f"{path}.tmp", "w") as file:
+            json.dump(self.families(), file)
+        os.replace(f"{path}.tmp", path)
+
+    def render(self, directory: str = None) -> str:
+        """ Values of this process, or of all workers which dump to directory """
+        if directory:
+            self.dump(directory)
+            families = _merge(_read_dumps(directory))
+        else:
+            families = self.families()
+
+        lines = []
+        for name, family in families.items():
+            lines.extend(_render_family(name, family))
+
+        return "\n".join(lines) + "\n"
+
+
+def _render_family(name: str, family: dict) -> list[str]:
+    lines = [f"# HELP {name} {family['help']}", f"# TYPE {name} {family['type']}"]
+    for labels, value in family["samples"]:
+        if family["type"] != "histogram":
+            lines.append(f"{name}{_format_labels(family['label_names'], labels)} {value}")
+            continue
+
+        counts, total, count = value
+        cumulative = 0
+        for bound, bucket_count in zip(family["buckets"], counts):
+            cumulative += bucket_count
+            lines.append(f"{name}_bucket{_format_labels(family['label_names'], labels, bound)} {cumulative}")
+
+        lines.append(f"{name}_bucket{_format_labels(family['label_names'], labels, '+Inf')} {count}")
+        lines.append(f"{name}_sum{_format_labels(family['label_names'], labels)} {total}")
+        lines.append(f"{name}_count{_format_labels(family['label_names'], labels)} {count}")
+
+    return lines
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def _read_dumps(directory: str) -> dict[int, dict]:
+    dumps = {}
+    for file_name in os.listdir(directory):
+        pid, extension = os.path.splitext(file_name)
+        if extension != ".json" or not pid.isdigit():
+            continue
+
+        try:
+            with open(os.path.join(directory, file_name)) as file:
+                dumps[int(pid)] = json.load(file)
+        except (OSError, ValueError):
+            # Removed or being replaced right now
+            continue
+
+    return dumps
+
+
+def _merge(dumps: dict[int, dict]) -> dict:
+    """
+        Counters and histograms are added up over all workers, also exited ones, so totals do not go back
+        when a worker is restarted. Gauges are per worker (labelled with its pid) and only of running workers.
+    """
+    merged = {}
+    for pid, families in sorted(dumps.items()):
+        alive = _is_alive(pid)
+        for name, family in families.items():
+            if family["type"] == "gauge" and not alive:
+                continue
+
+            target = merged.get(name)
+            if target is None:
+                target = merged[name] = dict(family, samples={})
+                if family["type"] == "gauge":
+                    target["label_names"] = family["label_names"] + ["worker"]
+
+            for labels, value in family["samples"]:
+                if family["type"] == "gauge":
+                    target["samples"][tuple(labels) + (pid,)] = value
+                elif family["type"] == "histogram":
+                    counts, total, count = target["samples"].get(tuple(labels), ([0] * len(value[0]), 0, 0))
+                    target["samples"][tuple(labels)] = ([a + b for a, b in zip(counts, value[0])],
+                                                        total + value[1], count + value[2])
+                else:
+                    target["samples"][tuple(labels)] = target["samples"].get(tuple(labels), 0) + value
+
+    for family in merged.values():
+        family["samples"] = list(family["samples"].items())
+
+    return merged
+
+
+def clear_dumps(directory: str):
+    """ Called before the workers start, values of a previous run must not be added to this one """
+    if not os.path.isdir(directory):
+        return
+
+    for file_name in os.listdir(directory):
+        if file_name.endswith((".json", ".json.tmp")):
+            os.unlink(os.path.join(directory, file_name))
+
+
+def metrics() -> Metrics:
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+
+    return _metrics
@@ -0,0 +1,151 @@
+import hashlib
+import threading
+import time
+
+from tinydb import Query
+
+import config
+from common.db import db
+from common.registry import registry
+
+_ownership = None
+
+
+class Projection:
+    """ What one user sees of the registry, rebuilt when the registry or the user's grants change """
+
+    __slots__ = ("key", "ids", "rooms", "serialized", "etag")
+
+    def __init__(self, key: tuple, devices: list):
+        self.key = key
+        self.ids = frozenset(dev.id for dev in devices)
+
+        self.rooms = {}
+        for dev in devices:
+            self.rooms.setdefault(dev.room, []).append(dev.id)
+
+        self.serialized = b"[" + b",".join(dev.get_serialized() for dev in devices) + b"]"
+        self.etag = hashlib.sha1(self.serialized).hexdigest()
+
+
+class Ownership:
+    """
+        Which devices each user may see and control, stored in the "ownership" table as rows
+        {"username": ..., "address": ...} for single devices or {"username": ..., "room": ...} for whole rooms
+        (devices discovered later in an owned room are owned too).
+        Rows are reloaded every reload_interval seconds, so grants made by another process show up here.
+    """
+
+    def __init__(self, reload_interval: float):
+        self.reload_interval = reload_interval
+        self.lock = threading.Lock()
+        self.reload_lock = threading.Lock()
+        self.loaded_at = 0
+        # username -> (frozenset of addresses, frozenset of rooms)
+        self.grants = {}
+        self.versions = {}
+        self.projections = {}
+
+    def table(self):
+        return db().table("ownership")
+
+    def reload(self, force: bool = False):
+        if not force and time.time() - self.loaded_at <= self.reload_interval:
+            return
+
+        # One thread reloads, the others keep using the grants they have (unless there are none yet)
+        if not self.reload_lock.acquire(blocking=force or self.loaded_at == 0):
+            return
+
+        try:
+            self.load()
+        finally:
+            self.reload_lock.release()
+
+    def load(self):
+        addresses, rooms = {}, {}
+        for row in self.table().all():
+            if "address" in row:
+                addresses.setdefault(row["username"], set()).add(row["address"])
+            if "room" in row:
+                rooms.setdefault(row["username"], set()).add(row["room"])
+
+        grants = {username: (frozenset(addresses.get(username, ())), frozenset(rooms.get(username, ())))
+                  for username in addresses.keys() | rooms.keys()}
+
+        with self.lock:
+            # Only users whose grants changed get a new version, and with it a new projection
+            for username in grants.keys() | self.grants.keys():
+                if grants.get(username) != self.grants.get(username):
+                    self.versions[username] = self.versions.get(username, 0) + 1
+                    self.projections.pop(username, None)
+
+            self.grants = grants
+            self.loaded_at = time.time()
+
+    @staticmethod
+    def make_row(username: str, address: str = None, room: str = None) -> dict:
+        return {"username": username, "address": address} if address is not None else {"username": username,
+                                                                                       "room": room}
+
+    @staticmethod
+    def row_query(row: dict):
+        Row = Query()
+        if "address" in row:
+            return (Row.username == row["username"]) & (Row.address == row["address"])
+
+        return (Row.username == row["username"]) & (Row.room == row["room"])
+
+    def grant(self, username: str, address: str = None, room: str = None):
+        # One locked table change, a check and a separate insert could add the grant twice
+        row = self.make_row(username, address, room)
+        self.table().upsert(row, self.row_query(row))
+        self.reload(force=True)
+
+    def revoke(self, username: str, address: str = None, room: str = None):
+        self.table().remove(self.row_query(self.make_row(username, address, room)))
+        self.reload(force=True)
+
+    def owns(self, username: str, device) -> bool:
+        self.reload()
+        addresses, rooms = self.grants.get(username, (frozenset(), frozenset()))
+        return device.id in addresses or device.room in rooms
+
+    def owners(self, device) -> list[str]:
+        self.reload()
+        return [username for username, (addresses, rooms) in self.grants.items()
+                if device.id in addresses or device.room in rooms]
+
+    def projection(self, username: str) -> Projection:
+        """ Costs O(user's devices): owned rooms come from the registry room index, single devices by address """
+        self.reload()
+
+        key = (registry().version, self.versions.get(username, 0))
+        projection = self.projections.get(username)
+        if projection is not None and projection.key == key:
+            return projection
+
+        addresses, rooms = self.grants.get(username, (frozenset(), frozenset()))
+
+        devices = {}
+        for room in sorted(rooms):
+            for dev in registry().get_room(room):
+                devices[dev.id] = dev
+        for address in sorted(addresses):
+            dev = registry().get(address)
+            if dev is not None:
+                devices[dev.id] = dev
+
+        projection = Projection(key, list(devices.values()))
+        with self.lock:
+            self.projections[username] = projection
+
+        return projection
+
+
+def ownership() -> Ownership:
+    global _ownership
+    if _ownership is None:
+        _ownership = Ownership(config.OWNERSHIP_RELOAD_INTERVAL)
+
+    return _ownership
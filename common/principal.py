@@ -0,0 +1,61 @@
+import threading
+import time
+from collections import OrderedDict
+
+import config
+
+_principal_cache = None
+
+
+class PrincipalCache:
+    """
+        Bounded LRU mapping bearer token value -> (Token, User). Entries also expire after ttl seconds,
+        which bounds how long a token revoked by another worker process keeps working here.
+    """
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, value: str):
+        with self.lock:
+            entry = self.entries.get(value)
+            if entry is None or entry[2] < time.time():
+                self.entries.pop(value, None)
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(value)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, value: str, token, user):
+        with self.lock:
+            self.entries[value] = (token, user, time.time() + self.ttl)
+            self.entries.move_to_end(value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate_token(self, value: str):
+        with self.lock:
+            self.entries.pop(value, None)
+
+    def invalidate_user(self, username: str):
+        with self.lock:
+            for value in [value for value, (_, user, _) in self.entries.items() if user.username == username]:
+                del self.entries[value]
+
+    def get_stats(self) -> dict:
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+def principal_cache() -> PrincipalCache:
+    global _principal_cache
+    if _principal_cache is None:
+        _principal_cache = PrincipalCache(config.PRINCIPAL_CACHE_SIZE, config.PRINCIPAL_CACHE_TTL)
+
+    return _principal_cache
@@ -0,0 +1,69 @@
+import threading
+import time
+from collections import deque
+
+import config
+
+_login_limiter = None
+
+
+class AttemptLimiter:
+    """
+        Allows at most max_attempts failures per key inside a sliding window of window seconds.
+        Counters live in the process, so with several workers each of them allows max_attempts.
+    """
+
+    def __init__(self, max_attempts: int, window: float):
+        self.max_attempts = max_attempts
+        self.window = window
+        self.lock = threading.Lock()
+        self.failures = {}
+        self.swept_at = time.time()
+
+    def _prune(self, key: str, now: float) -> deque:
+        failures = self.failures.get(key)
+        if failures is None:
+            return deque()
+
+        while failures and now - failures[0] > self.window:
+            failures.popleft()
+
+        if not failures:
+            del self.failures[key]
+
+        return failures
+
+    def _sweep(self, now: float):
+        # Keys which are never asked again would stay forever, drop the expired ones once per window
+        if now - self.swept_at < self.window:
+            return
+
+        self.swept_at = now
+        for key in list(self.failures):
+            self._prune(key, now)
+
+    def is_limited(self, *keys: str) -> bool:
+        now = time.time()
+        with self.lock:
+            return any(len(self._prune(key, now)) >= self.max_attempts for key in keys)
+
+    def add_failure(self, *keys: str):
+        now = time.time()
+        with self.lock:
+            self._sweep(now)
+            for key in keys:
+                self._prune(key, now)
+                self.failures.setdefault(key, deque()).append(now)
+
+    def reset(self, *keys: str):
+        with self.lock:
+            for key in keys:
+                self.failures.pop(key, None)
+
+
+def login_limiter() -> AttemptLimiter:
+    global _login_limiter
+    if _login_limiter is None:
+        _login_limiter = AttemptLimiter(config.LOGIN_MAX_ATTEMPTS, config.LOGIN_ATTEMPT_WINDOW)
+
+    return _login_limiter
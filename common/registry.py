@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+_registry = None
+
+
+class Registry:
+    """
+        Devices known to the skill keyed by Khawasu address. Every entry is a Yandex view
+        (common.device.Device) which holds the Khawasu view of the same device in khawasu_device.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.discovery_lock = threading.Lock()
+        self.devices = {}
+        # room (Khawasu group name) -> addresses of its devices
+        self.rooms = {}
+        self.version = 0
+        self.loaded_at = 0
+        # Start of the last discovery, failed ones included, so a failing mesh is not asked on every request
+        self.last_attempt = 0
+        self.background_refresh = None
+        self.row_objects = []
+        self.row_objects_version = 0
+        self.serialized = b"[]"
+        self.serialized_etag = ""
+        self.serialized_version = 0
+        self.refresher = None
+
+    @property
+    def loaded(self) -> bool:
+        return self.version > 0
+
+    def needs_discovery(self, ttl: float, retry_interval: float) -> bool:
+        now = time.time()
+        return now - self.loaded_at > ttl and now - self.last_attempt > retry_interval
+
+    def invalidate(self):
+        self.loaded_at = 0
+        self.last_attempt = 0
+
+    def refresh_in_background(self, discover):
+        """ Runs discover on its own thread unless it is running already, the caller does not wait for it """
+        with self.lock:
+            if self.background_refresh is not None and self.background_refresh.is_alive():
+                return
+
+            def run():
+                try:
+                    discover()
+                except Exception as ex:
+                    log.warning("Error in device discovery: %r", ex)
+
+            self.background_refresh = threading.Thread(target=run, name="discovery-background", daemon=True)
+            self.background_refresh.start()
+
+    def get(self, address: str):
+        return self.devices.get(address)
+
+    def all(self) -> list:
+        return list(self.devices.values())
+
+    def get_room(self, room: str) -> list:
+        devices = self.devices
+        return [devices[address] for address in self.rooms.get(room, ()) if address in devices]
+
+    def get_row_objects(self) -> list[dict]:
+        if self.row_objects_version != self.version:
+            with self.lock:
+                self.row_objects = [dev.get_row_object() for dev in self.devices.values()]
+                self.row_objects_version = self.version
+
+        return self.row_objects
+
+    def get_serialized_row_objects(self) -> tuple[bytes, str]:
+        """
+            Device list encoded as a JSON array together with its ETag, both recomputed only when the version changes.
+            The ETag is a content hash so it stays valid across restarts.
+        """
+        if self.serialized_version != self.version:
+            with self.lock:
+                # Same bytes as dumping the row object list, but unchanged devices reuse their encoding
+                self.serialized = b"[" + b",".join(dev.get_serialized() for dev in self.devices.values()) + b"]"
+                self.serialized_etag = hashlib.sha1(self.serialized).hexdigest()
+                self.serialized_version = self.version
+
+        return self.serialized, self.serialized_etag
+
+    def update(self, khawasu_devices: list, build) -> bool:
+        """
+            Apply a fresh discovery result. Entries whose Khawasu device object did not change are kept,
+            the rest is rebuilt with build(khawasu_device). Returns True if anything changed.
+        """
+        with self.lock:
+            devices = {}
+            for khawasu_device in khawasu_devices:
+                dev = self.devices.get(khawasu_device.address)
+                devices[khawasu_device.address] = dev if dev is not None and dev.khawasu_device is khawasu_device \
+                    else build(khawasu_device)
+
+            changed = not self.loaded or devices.keys() != self.devices.keys() or \
+                any(dev is not self.devices[address] for address, dev in devices.items())
+
+            if changed:
+                rooms = {}
+                for address, dev in devices.items():
+                    rooms.setdefault(dev.room, []).append(address)
+                self.rooms = {room: tuple(addresses) for room, addresses in rooms.items()}
+
+            self.devices = devices
+            self.loaded_at = time.time()
+            if changed:
+                self.version += 1
+
+            return changed
+
+    def start_refresher(self, interval: float, discover, immediately: bool = False):
+        """ Calls discover every interval seconds, immediately also calls it once right away (even with interval 0) """
+        if self.refresher is not None or (interval <= 0 and not immediately):
+            return
+
+        def refresh_loop():
+            wait = not immediately
+            while True:
+                if wait:
+                    time.sleep(interval)
+                wait = True
+
+                try:
+                    discover()
+                except Exception:
+                    log.exception("Error in device discovery")
+
+                if interval <= 0:
+                    return
+
+        self.refresher = threading.Thread(target=refresh_loop, name="discovery-refresh", daemon=True)
+        self.refresher.start()
+
+
+def registry() -> Registry:
+    global _registry
+    if _registry is None:
+        _registry = Registry()
+
+    return _registry
@@ -0,0 +1,142 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+
+import config
+from common.callback import send_state
+from common.ownership import ownership
+from common.registry import registry
+from common.user import User
+
+log = logging.getLogger(__name__)
+
+_state_reporter = None
+
+
+class StateReporter:
+    """
+        Collects state changes from subscriptions, keeps only the latest value per (address, action_name)
+        and sends them in batches to the Yandex callback API. While the callback fails, new changes keep
+        replacing pending ones instead of piling up, and at most max_pending actions are kept.
+    """
+
+    def __init__(self, debounce: float, batch_size: int, max_pending: int, backoff: float, backoff_max: float):
+        self.debounce = debounce
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+
+        self.lock = threading.Lock()
+        self.pending = OrderedDict()
+        self.dropped = 0
+        self.failures = 0
+        self.thread = threading.Thread(target=self.flush_loop, name="state-reporter", daemon=True)
+        self.thread.start()
+
+    def report(self, address: str, action_name: str, value: Any):
+        with self.lock:
+            self.pending.pop((address, action_name), None)
+            self.pending[(address, action_name)] = value
+
+            while len(self.pending) > self.max_pending:
+                self.pending.popitem(last=False)
+                self.dropped += 1
+
+    def take_batch(self) -> list[tuple[tuple[str, str], Any]]:
+        batch = []
+        with self.lock:
+            devices = set()
+            for key in list(self.pending):
+                if key[0] not in devices and len(devices) >= self.batch_size:
+                    break
+
+                devices.add(key[0])
+                batch.append((key, self.pending.pop(key)))
+
+        return batch
+
+    def put_back(self, batch: list[tuple[tuple[str, str], Any]]):
+        with self.lock:
+            for key, value in batch:
+                # Newer values reported in the meantime win
+                if key not in self.pending:
+                    self.pending[key] = value
+                    self.pending.move_to_end(key, last=False)
+
+    @staticmethod
+    def build_devices(batch: list[tuple[tuple[str, str], Any]]) -> list[dict]:
+        devices = OrderedDict()
+        for (address, action_name), value in batch:
+            device = registry().get(address)
+            if device is None or action_name not in device.items_by_action:
+                continue
+
+            section, item = device.items_by_action[action_name]
+            devices.setdefault(address, {'id': address, 'capabilities': [], 'properties': []})[section].append({
+                'type': item["type"],
+                'state': {"instance": item["parameters"]["instance"], "value": value}
+            })
+
+        return list(devices.values())
+
+    @staticmethod
+    def split_by_owner(devices: list[dict]) -> dict[str, list[dict]]:
+        if not config.DEVICE_OWNERSHIP_ENABLED:
+            return {user.username: devices for user in User.get_all()}
+
+        by_owner = {}
+        for device in devices:
+            registered = registry().get(device['id'])
+            # Gone since the change was reported, nobody owns it any more
+            if registered is None:
+                continue
+
+            for username in ownership().owners(registered):
+                by_owner.setdefault(username, []).append(device)
+
+        return by_owner
+
+    def flush_loop(self):
+        while True:
+            time.sleep(self.debounce if self.failures == 0 else
+                       min(self.backoff * 2 ** (self.failures - 1), self.backoff_max))
+
+            while True:
+                batch = self.take_batch()
+                if not batch:
+                    break
+
+                devices = self.build_devices(batch)
+                if not devices:
+                    continue
+
+                failed = set()
+                for username, user_devices in self.split_by_owner(devices).items():
+                    try:
+                        sent = send_state(username, user_devices)
+                    except Exception as ex:
+                        log.warning("Error in state report: %r", ex, extra={"username": username})
+                        sent = False
+
+                    if not sent:
+                        failed.update(device['id'] for device in user_devices)
+
+                # Users who got their report are not sent it again, unless they share a device with a failed one
+                if failed:
+                    self.failures += 1
+                    self.put_back([item for item in batch if item[0][0] in failed])
+                    break
+
+                self.failures = 0
+
+
+def state_reporter() -> StateReporter:
+    global _state_reporter
+    if _state_reporter is None:
+        _state_reporter = StateReporter(config.REPORT_DEBOUNCE, config.REPORT_BATCH_SIZE, config.REPORT_MAX_PENDING,
+                                        config.REPORT_RETRY_BACKOFF, config.REPORT_RETRY_BACKOFF_MAX)
+
+    return _state_reporter
@@ -0,0 +1,31 @@
+import gzip
+import json
+
+from flask import Response, request
+
+import config
+
+
+def encode_json_value(value) -> bytes:
+    return json.dumps(value, separators=(",", ":")).encode()
+
+
+def raw_json_response(body: bytes, etag: str = None) -> Response:
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+
+    response = Response(body, mimetype="application/json")
+
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+        response.headers["Cache-Control"] = "private, no-cache"
+
+    if config.RESPONSE_GZIP_ENABLED and len(body) >= config.RESPONSE_GZIP_MIN_SIZE:
+        response.vary.add("Accept-Encoding")
+        if "gzip" in request.accept_encodings:
+            response.set_data(gzip.compress(body, config.RESPONSE_GZIP_LEVEL))
+            response.headers["Content-Encoding"] = "gzip"
+
+    return response
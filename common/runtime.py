@@ -0,0 +1,170 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+import config
+import khawasu_stuff.device
+
+from common import action_queue, executor, khawasu, mesh, reporter, state, user
+from common.callback import state_reporting_enabled
+from common.device import Device, get_capability_templates, get_yandex_device_param_map
+from common.log import setup_logging, stop_logging
+from common.metrics import metrics
+from common.principal import principal_cache
+from common.registry import registry
+from common.reporter import state_reporter
+from common.state import state_cache
+from common.user import get_dummy_password_hash
+
+log = logging.getLogger(__name__)
+
+_started_pid = None
+
+
+def start():
+    """ Starts background work of the current process, calling it again in the same process does nothing """
+    global _started_pid
+    if _started_pid == os.getpid():
+        return
+
+    _started_pid = os.getpid()
+    setup_logging()
+    register_metrics()
+    start_metrics_dump()
+
+    # Asset maps are parsed (and the dummy password hashed) now instead of on the first request
+    get_capability_templates()
+    get_yandex_device_param_map()
+    get_dummy_password_hash()
+
+    # Other workers copy the registry of the mesh owner instead
+    if mesh.claim():
+        Device.load_snapshot()
+        start_state_reporting()
+
+    mesh.start_mesh(mesh_handlers(), rediscover, promote)
+    Device.start_refresher()
+
+    # atexit would only run after the driver socket threads, which are not daemons, are joined: never
+    threading._register_atexit(shutdown)
+
+
+def start_state_reporting():
+    # Subscriptions only run in the mesh owner, so only it sees state changes
+    if state_reporting_enabled():
+        state_cache().add_listener(state_reporter().report)
+
+
+def mesh_handlers() -> dict:
+    # Reads are answered from the state cache or by the query executor, the other calls may block and get a thread
+    return {
+        "devices": lambda known_key: executor.query_executor().submit(serve_devices, known_key),
+        "read": serve_read,
+        "execute": lambda *args: executor.action_executor().submit(serve_execute, *args),
+    }
+
+
+def serve_devices(known_key: tuple | None) -> tuple[tuple, list[dict] | None]:
+    """ Owner side of MeshClient.fetch_devices, rows are only sent when the registry changed since known_key """
+    Device.refresh_if_stale()
+
+    # An owner which did not find its devices yet has nothing to copy, this is not an empty mesh
+    if not registry().loaded:
+        raise ConnectionError("Mesh owner has not discovered the devices yet")
+
+    key = (os.getpid(), registry().version)
+    return key, None if key == known_key else [dev.khawasu_device.to_row() for dev in registry().all()]
+
+
+def get_served_device(address: str) -> khawasu_stuff.device.Device:
+    device = registry().get(address)
+    if device is None or device.khawasu_device is None:
+        raise LookupError(f"Device {address} is not known to the mesh owner")
+
+    return device.khawasu_device
+
+
+def serve_read(address: str, action_name: str) -> Future:
+    return Device.read_state(get_served_device(address), action_name)
+
+
+def serve_execute(address: str, action_name: str, value) -> bool:
+    return Device.execute_action(get_served_device(address), action_name, value)
+
+
+def rediscover():
+    """ The mesh owner exited: devices copied from it have no pool, find them on the mesh before taking over """
+    registry().invalidate()
+    Device.refresh(force=True, direct=True)
+
+
+def promote():
+    """ This worker took over the mesh, start what only the owner runs """
+    Device.track_states()
+    start_state_reporting()
+
+
+def register_metrics():
+    # Objects which are not created yet are not started by reading them
+    def size_of(getter):
+        return lambda: {(): len(getter().pending)} if getter() is not None else {}
+
+    def per_gateway(count):
+        return lambda: {(pool.name,): count(pool) for pool in khawasu._khawasu_driver_pools or ()}
+
+    metrics().gauge("mesh_owner", "1 in the worker process talking to the Khawasu mesh",
+                    lambda: {(): int(mesh.mesh_client() is None)})
+    metrics().gauge("registry_devices", "Devices known from discovery", lambda: {(): len(registry().devices)})
+    metrics().gauge("khawasu_gateway_devices", "Devices found on the gateway by the last discovery",
+                    per_gateway(lambda pool: len(pool.devices)), ("gateway",))
+    metrics().gauge("khawasu_open_circuits", "Devices reported unreachable without asking them",
+                    per_gateway(lambda pool: len(pool.breaker.open_keys())), ("gateway",))
+    metrics().gauge("principal_cache_entries", "Cached access tokens",
+                    lambda: {(): principal_cache().get_stats()["size"]})
+    metrics().gauge("principal_cache_lookups_total", "Access token lookups by result",
+                    lambda: {("hit",): principal_cache().hits, ("miss",): principal_cache().misses}, ("result",),
+                    kind="counter")
+    metrics().gauge("state_cache_values", "Cached device states",
+                    lambda: {(): len(state._state_cache.values)} if state._state_cache is not None else {})
+    metrics().gauge("action_queue_pending", "Queued actions", size_of(lambda: action_queue._action_queue))
+    metrics().gauge("state_reports_pending", "Changed states waiting for the callback API",
+                    size_of(lambda: reporter._state_reporter))
+    metrics().gauge("state_reports_dropped_total", "Changed states dropped while the callback API was failing",
+                    lambda: {(): reporter._state_reporter.dropped} if reporter._state_reporter is not None else {},
+                    kind="counter")
+
+
+def start_metrics_dump():
+    # The worker answering a scrape adds up what the others left in METRICS_DIR
+    if not config.METRICS_ENABLED or not config.METRICS_DIR:
+        return
+
+    def dump_loop():
+        while True:
+            try:
+                metrics().dump(config.METRICS_DIR)
+            except Exception as ex:
+                log.warning("Error in metrics dump: %r", ex)
+            time.sleep(config.METRICS_DUMP_INTERVAL)
+
+    threading.Thread(target=dump_loop, name="metrics-dump", daemon=True).start()
+
+
+def shutdown():
+    for pool in (executor._query_executor, executor._action_executor, user._password_executor):
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    mesh.close_mesh()
+    khawasu.close_driver_pools()
+
+    # Counters of an exiting worker keep counting in the totals
+    if config.METRICS_ENABLED and config.METRICS_DIR:
+        try:
+            metrics().dump(config.METRICS_DIR)
+        except Exception as ex:
+            log.warning("Error in metrics dump: %r", ex)
+
+    stop_logging()
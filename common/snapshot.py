@@ -0,0 +1,53 @@
+import json
+import logging
+import os
+import time
+
+import config
+
+log = logging.getLogger(__name__)
+
+# Bumped when the layout changes, snapshots of other versions are ignored
+SNAPSHOT_FORMAT = 1
+
+
+def save_snapshot(rows_by_gateway: dict[str, list[dict]]):
+    """ Writes the raw list-devices rows of every gateway, replacing the previous snapshot atomically """
+    if not config.DISCOVERY_SNAPSHOT_PATH:
+        return
+
+    # Every worker process may save, each through its own temporary file
+    path = f"{config.DISCOVERY_SNAPSHOT_PATH}.{os.getpid()}.tmp"
+    try:
+        data = json.dumps({"format": SNAPSHOT_FORMAT, "saved_at": time.time(), "gateways": rows_by_gateway},
+                          separators=(",", ":"), ensure_ascii=False).encode()
+        with open(path, "wb") as file:
+            file.write(data)
+        os.replace(path, config.DISCOVERY_SNAPSHOT_PATH)
+    except (OSError, TypeError, ValueError) as ex:
+        log.warning("Error in discovery snapshot save: %r", ex)
+
+
+def load_snapshot() -> dict[str, list[dict]] | None:
+    """ Rows by gateway name from the last snapshot, None if there is no usable one """
+    if not config.DISCOVERY_SNAPSHOT_PATH:
+        return None
+
+    try:
+        with open(config.DISCOVERY_SNAPSHOT_PATH, "rb") as file:
+            snapshot = json.loads(file.read())
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as ex:
+        log.warning("Error in discovery snapshot load: %r", ex)
+        return None
+
+    if snapshot.get("format") != SNAPSHOT_FORMAT:
+        log.info("Discovery snapshot has another format, ignoring it")
+        return None
+
+    if time.time() - snapshot["saved_at"] > config.DISCOVERY_SNAPSHOT_MAX_AGE:
+        log.info("Discovery snapshot is too old, ignoring it")
+        return None
+
+    return snapshot["gateways"]
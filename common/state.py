@@ -0,0 +1,114 @@
+import logging
+import threading
+import time
+from typing import Any
+
+import config
+import khawasu_stuff.device
+
+log = logging.getLogger(__name__)
+
+_state_cache = None
+
+
+class StateCache:
+    RENEW_CHECK_INTERVAL = 1
+    RENEW_RETRY_DELAY = 30
+
+    def __init__(self, period: int, duration: int, renew_margin: int):
+        self.period = period
+        self.duration = duration
+        self.renew_margin = renew_margin
+
+        self.lock = threading.Lock()
+        # (address, action_name) -> (value, timestamp)
+        self.values = {}
+        # (address, action_name) -> [khawasu device, subscription expiration time]
+        self.subscriptions = {}
+        self.renew_thread = None
+        # Called as listener(address, action_name, value) when a subscription reports a changed value
+        self.listeners = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def get(self, address: str, action_name: str, max_staleness: float) -> Any:
+        entry = self.values.get((address, action_name))
+        if entry is None or time.time() - entry[1] > max_staleness:
+            return None
+
+        return entry[0]
+
+    def put(self, address: str, action_name: str, value: Any):
+        if value is None:
+            return
+
+        self.values[(address, action_name)] = (value, time.time())
+
+    def invalidate(self, address: str, action_name: str):
+        self.values.pop((address, action_name), None)
+
+    def fetch(self, khawasu_device: khawasu_stuff.device.Device, action_name: str) -> Any:
+        value = khawasu_device.get(action_name)
+        self.put(khawasu_device.address, action_name, value)
+
+        return value
+
+    async def fetch_async(self, khawasu_device: khawasu_stuff.device.Device, action_name: str) -> Any:
+        value = await khawasu_device.get_async(action_name)
+        self.put(khawasu_device.address, action_name, value)
+
+        return value
+
+    def on_update(self, address: str, action_name: str, value: Any):
+        previous = self.values.get((address, action_name))
+        self.put(address, action_name, value)
+
+        if value is None or previous is None or previous[0] == value:
+            return
+
+        for listener in self.listeners:
+            listener(address, action_name, value)
+
+    def track(self, subscriptions: dict[tuple[str, str], khawasu_stuff.device.Device]):
+        # Replace the set of watched actions, subscriptions already made stay valid until they expire
+        with self.lock:
+            self.subscriptions = {key: [khawasu_device, self.subscriptions.get(key, [None, 0])[1]]
+                                  for key, khawasu_device in subscriptions.items()}
+
+            for key in list(self.values):
+                if key not in self.subscriptions:
+                    del self.values[key]
+
+        if self.renew_thread is None:
+            self.renew_thread = threading.Thread(target=self.renew_loop, name="state-renew", daemon=True)
+            self.renew_thread.start()
+
+    def renew_loop(self):
+        while True:
+            now = time.time()
+            with self.lock:
+                expiring = [(key, entry) for key, entry in self.subscriptions.items()
+                            if entry[1] - now < self.renew_margin]
+
+            for (address, action_name), entry in expiring:
+                try:
+                    if entry[0].subscribe(action_name, self.period, self.duration, self.on_update):
+                        entry[1] = now + self.duration
+                        continue
+                except Exception as ex:
+                    log.warning("Error in subscribe: %r", ex, extra={"address": address, "action": action_name})
+
+                # Try again later instead of hammering an unreachable device
+                entry[1] = now + self.renew_margin + self.RENEW_RETRY_DELAY
+
+            time.sleep(self.RENEW_CHECK_INTERVAL)
+
+
+def state_cache() -> StateCache:
+    global _state_cache
+    if _state_cache is None:
+        _state_cache = StateCache(config.STATE_SUBSCRIBE_PERIOD, config.STATE_SUBSCRIBE_DURATION,
+                                  config.STATE_RENEW_MARGIN)
+
+    return _state_cache
@@ -2,9 +2,11 @@ import random
 import string
 import time
 
-from tinydb import Query
+import config
+from common.principal import principal_cache
+from common.token_store import token_store
 
-from common.db import db
+_last_purge_time = 0
 
 
 class Token:
@@ -21,11 +23,16 @@ class Token:
     def check_expired(self):
         return time.time() - self.generated_time > Token.MAX_DELAY_TIME
 
+    def is_code(self):
+        # Authorization codes carry the OAuth state, access tokens are generated without one
+        return self.state != 0
+
     def save(self):
-        db().table("tokens").insert(self.get_row_object())
+        token_store().insert(self.get_row_object())
 
     def revoke(self):
-        db().table("tokens").remove(Query().value == self.value)
+        token_store().remove(self.value)
+        principal_cache().invalidate_token(self.value)
 
     def get_row_object(self):
         return {"value": self.value, "username": self.username, "state": self.state,
@@ -33,15 +40,25 @@ class Token:
 
     @classmethod
     def get_by_value(cls, value: str):
-        _token = Query()
-        rows = db().table("tokens").search(_token.value == value)
-        return None if len(rows) == 0 else cls.from_row_object(rows[0])
+        row = token_store().get(value)
+        return None if row is None else cls.from_row_object(row)
+
+    @classmethod
+    def purge_expired(cls):
+        # Same limit as check_expired
+        token_store().purge_codes(time.time() - Token.MAX_DELAY_TIME)
 
     @classmethod
     def _emit(cls, value: str, username: str, state: str):
+        global _last_purge_time
+
         new_token = Token(value, username, state, int(time.time()))
         new_token.save()
 
+        if time.time() - _last_purge_time > config.TOKEN_PURGE_INTERVAL:
+            _last_purge_time = time.time()
+            cls.purge_expired()
+
         return new_token
 
     @classmethod
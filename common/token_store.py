@@ -0,0 +1,178 @@
+import json
+import os
+import sqlite3
+import threading
+
+from tinydb import Query
+
+import config
+from common.db import db
+
+_token_store = None
+
+
+def is_code_before(row: dict, generated_before: float) -> bool:
+    """ Row of an authorization code generated before generated_before """
+    return row["state"] != 0 and row["generated_time"] < generated_before
+
+
+class TinyDBTokenStore:
+    """ Tokens table inside the main TinyDB file, every lookup scans the table """
+
+    def get(self, value: str) -> dict | None:
+        rows = db().table("tokens").search(Query().value == value)
+        return None if len(rows) == 0 else rows[0]
+
+    def insert(self, row: dict):
+        db().table("tokens").insert(row)
+
+    def remove(self, value: str):
+        db().table("tokens").remove(Query().value == value)
+
+    def all(self) -> list[dict]:
+        return db().table("tokens").all()
+
+    def purge(self, predicate):
+        db().table("tokens").remove(predicate)
+
+    def purge_codes(self, generated_before: float):
+        self.purge(lambda row: is_code_before(row, generated_before))
+
+
+class MemoryTokenStore:
+    """
+        Tokens in a dict keyed by value, persisted to an append-only journal of JSON lines.
+        The journal is compacted on startup. Only safe when a single process owns the file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.rows = {}
+
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as file:
+                for line in file:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    if entry["op"] == "add":
+                        self.rows[entry["row"]["value"]] = entry["row"]
+                    else:
+                        self.rows.pop(entry["value"], None)
+        else:
+            self.rows = {row["value"]: row for row in TinyDBTokenStore().all()}
+
+        # Rewrite the journal with live tokens only
+        with open(path + ".tmp", "w", encoding="utf-8") as file:
+            for row in self.rows.values():
+                file.write(json.dumps({"op": "add", "row": row}) + "\n")
+        os.replace(path + ".tmp", path)
+
+        self.journal = open(path, "a", encoding="utf-8")
+
+    def _append(self, entry: dict):
+        self.journal.write(json.dumps(entry) + "\n")
+        self.journal.flush()
+
+    def get(self, value: str) -> dict | None:
+        return self.rows.get(value)
+
+    def insert(self, row: dict):
+        with self.lock:
+            self.rows[row["value"]] = row
+            self._append({"op": "add", "row": row})
+
+    def remove(self, value: str):
+        with self.lock:
+            if self.rows.pop(value, None) is not None:
+                self._append({"op": "del", "value": value})
+
+    def all(self) -> list[dict]:
+        return list(self.rows.values())
+
+    def purge(self, predicate):
+        with self.lock:
+            for row in [row for row in self.rows.values() if predicate(row)]:
+                del self.rows[row["value"]]
+                self._append({"op": "del", "value": row["value"]})
+
+    def purge_codes(self, generated_before: float):
+        self.purge(lambda row: is_code_before(row, generated_before))
+
+
+class SQLiteTokenStore:
+    """ Tokens in SQLite (WAL mode) with value as the primary key, safe to share between processes """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+
+        connection = self.connection()
+        connection.execute("CREATE TABLE IF NOT EXISTS tokens "
+                           "(value TEXT PRIMARY KEY, username TEXT, state, generated_time INTEGER)")
+
+        # First start after switching from TinyDB: take the issued tokens along
+        if connection.execute("SELECT COUNT(*) FROM tokens").fetchone()[0] == 0:
+            with connection:
+                connection.executemany("INSERT OR IGNORE INTO tokens VALUES (?, ?, ?, ?)",
+                                       [self.to_tuple(row) for row in TinyDBTokenStore().all()])
+
+    def connection(self) -> sqlite3.Connection:
+        # sqlite3 connections must not be shared between threads
+        if getattr(self.local, "connection", None) is None:
+            self.local.connection = sqlite3.connect(self.path, timeout=10)
+            self.local.connection.execute("PRAGMA journal_mode=WAL")
+            self.local.connection.execute("PRAGMA synchronous=NORMAL")
+
+        return self.local.connection
+
+    @staticmethod
+    def to_tuple(row: dict) -> tuple:
+        return row["value"], row["username"], row["state"], row["generated_time"]
+
+    @staticmethod
+    def to_row(values: tuple) -> dict:
+        return {"value": values[0], "username": values[1], "state": values[2], "generated_time": values[3]}
+
+    def get(self, value: str) -> dict | None:
+        values = self.connection().execute("SELECT value, username, state, generated_time FROM tokens "
+                                           "WHERE value = ?", (value,)).fetchone()
+        return None if values is None else self.to_row(values)
+
+    def insert(self, row: dict):
+        with self.connection() as connection:
+            connection.execute("INSERT INTO tokens VALUES (?, ?, ?, ?)", self.to_tuple(row))
+
+    def remove(self, value: str):
+        with self.connection() as connection:
+            connection.execute("DELETE FROM tokens WHERE value = ?", (value,))
+
+    def all(self) -> list[dict]:
+        return [self.to_row(values) for values in
+                self.connection().execute("SELECT value, username, state, generated_time FROM tokens")]
+
+    def purge(self, predicate):
+        expired = [(row["value"],) for row in self.all() if predicate(row)]
+        with self.connection() as connection:
+            connection.executemany("DELETE FROM tokens WHERE value = ?", expired)
+
+    def purge_codes(self, generated_before: float):
+        # Access tokens are stored with state 0, see Token.is_code
+        with self.connection() as connection:
+            connection.execute("DELETE FROM tokens WHERE state IS NOT 0 AND generated_time < ?", (generated_before,))
+
+
+def token_store():
+    global _token_store
+    if _token_store is None:
+        if config.TOKEN_STORE_BACKEND == "sqlite":
+            _token_store = SQLiteTokenStore(config.TOKEN_STORE_PATH)
+        elif config.TOKEN_STORE_BACKEND == "memory":
+            _token_store = MemoryTokenStore(config.TOKEN_JOURNAL_PATH)
+        elif config.TOKEN_STORE_BACKEND == "tinydb":
+            _token_store = TinyDBTokenStore()
+        else:
+            raise ValueError(f"Unknown token store backend: {config.TOKEN_STORE_BACKEND}")
+
+    return _token_store
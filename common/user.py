@@ -1,9 +1,49 @@
-import hashlib
+import hmac
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 import bcrypt as bcrypt
 from tinydb import Query
 
+import config
 from common.db import db
+from common.metrics import metrics
+from common.principal import principal_cache
+
+_password_executor = None
+_dummy_password_hash = None
+
+_bcrypt_seconds = metrics().histogram("bcrypt_seconds", "Duration of password hashing, including the wait for a "
+                                      "password worker", ("operation",))
+
+
+def password_executor() -> ProcessPoolExecutor:
+    global _password_executor
+    if _password_executor is None:
+        # Forking a worker with running threads may copy held locks into the child, spawn starts it clean
+        _password_executor = ProcessPoolExecutor(max_workers=config.PASSWORD_WORKERS,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+
+    return _password_executor
+
+
+def get_dummy_password_hash() -> str:
+    """ Logins of unknown users are checked against this hash, so they take as long as wrong passwords """
+    global _dummy_password_hash
+    if _dummy_password_hash is None:
+        _dummy_password_hash = _hash_password("", config.BCRYPT_ROUNDS)[0]
+
+    return _dummy_password_hash
+
+
+# Runs inside the password executor processes, so it has to stay a plain module level function
+def _verify_password(password: str, password_hash: str) -> bool:
+    return hmac.compare_digest(bcrypt.hashpw(password.encode(), password_hash.encode()), password_hash.encode())
+
+
+def _hash_password(password: str, rounds: int) -> tuple[str, str]:
+    salt = bcrypt.gensalt(rounds=rounds).decode()
+    return bcrypt.hashpw(password.encode(), salt.encode()).decode(), salt
 
 
 class User:
@@ -14,21 +54,30 @@ class User:
         self.salt = salt
 
     def remove(self):
-        pass
+        principal_cache().invalidate_user(self.username)
 
     def hash_password(self, password: str):
         return bcrypt.hashpw(password.encode(), self.salt.encode()).decode()
 
+    def get_hash_rounds(self) -> int:
+        # $2b$<rounds>$<salt and hash>
+        return int(self.password_hash.split("$")[2])
+
     def get_row_object(self):
         return {"id": self.id, "username": self.username, "password_hash": self.password_hash, "salt": self.salt}
 
     def save(self):
         db().table("users").insert(self.get_row_object())
+        principal_cache().invalidate_user(self.username)
+
+    def update(self):
+        db().table("users").update(self.get_row_object(), Query().username == self.username)
+        principal_cache().invalidate_user(self.username)
 
     @classmethod
     def create(cls, username: str, password: str):
-        salt = bcrypt.gensalt().decode()
-        password_hash = bcrypt.hashpw(password.encode(), salt.encode()).decode()
+        with _bcrypt_seconds.time("hash"):
+            password_hash, salt = _hash_password(password, config.BCRYPT_ROUNDS)
 
         new_user = cls(0, username, password_hash, salt)
         new_user.save()
@@ -45,6 +94,10 @@ class User:
         user_row = db().table("users").search(User.username == username)
         return None if len(user_row) == 0 else cls.from_row_object(user_row[0])
 
+    @classmethod
+    def get_all(cls):
+        return [cls.from_row_object(row) for row in db().table("users").all()]
+
     @classmethod
     def get_by_id(cls, id: int):
         User = Query()
@@ -52,5 +105,19 @@ class User:
         return None if len(user_row) == 0 else cls.from_row_object(user_row[0])
 
 
-def check_login(user: User, password: str):
-    return user is not None and user.password_hash == user.hash_password(password)
+def check_login(user: User | None, password: str):
+    # bcrypt is CPU bound, keep it away from the request threads
+    with _bcrypt_seconds.time("verify"):
+        password_hash = get_dummy_password_hash() if user is None else user.password_hash
+        verified = password_executor().submit(_verify_password, password, password_hash)
+        if not verified.result(timeout=config.PASSWORD_VERIFY_TIMEOUT) or user is None:
+            return False
+
+    # Work factor changed since the hash was made: upgrade it while we know the password
+    if user.get_hash_rounds() != config.BCRYPT_ROUNDS:
+        with _bcrypt_seconds.time("hash"):
+            rehashed = password_executor().submit(_hash_password, password, config.BCRYPT_ROUNDS)
+            user.password_hash, user.salt = rehashed.result(timeout=config.PASSWORD_VERIFY_TIMEOUT)
+        user.update()
+
+    return True
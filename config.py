@@ -8,4 +8,141 @@ DATABASE_PATH = 'db.json'
 
 KHAWASU_ADDR = '127.0.0.1'
 KHAWASU_PORT = 1234
-KHAWASU_DEBUG_MODE = True
\ No newline at end of file
+KHAWASU_DEBUG_MODE = True
+# Logical adapters (addr, port) of the site, devices are discovered on all of them and commanded
+# through the one they were found on
+KHAWASU_GATEWAYS = [(KHAWASU_ADDR, KHAWASU_PORT)]
+
+# How many action_get calls may be in flight at once for /devices/query
+QUERY_MAX_WORKERS = 32
+# Seconds to wait for device states before answering with DEVICE_UNREACHABLE
+QUERY_DEADLINE = 2.5
+
+# How many devices may be commanded at once for /devices/action
+ACTION_MAX_WORKERS = 32
+# Seconds to wait for commands to be dispatched before reporting DEVICE_UNREACHABLE. Commands not sent by then
+# are dropped, one which is being sent at that moment may still reach the device.
+ACTION_DEADLINE = 2.5
+
+# Keep device states in memory from Khawasu subscriptions instead of asking the mesh on every query
+STATE_CACHE_ENABLED = True
+# How often subscribed devices report their state (milliseconds)
+STATE_SUBSCRIBE_PERIOD = 5000
+# Subscription lifetime (seconds), renewed STATE_RENEW_MARGIN seconds before it expires
+STATE_SUBSCRIBE_DURATION = 600
+STATE_RENEW_MARGIN = 30
+# Cached states older than this (seconds) are fetched from the device again
+STATE_MAX_STALENESS = 30
+
+# Seconds a discovery result (list-devices) is served before the mesh is asked again
+DISCOVERY_TTL = 300
+# A failed discovery is not tried again by requests for this many seconds, they are served the devices known already
+DISCOVERY_RETRY_INTERVAL = 30
+# Background rediscovery period in seconds, 0 disables the refresher thread
+DISCOVERY_REFRESH_INTERVAL = 60
+# Last discovery result is kept here and served right after a restart while the mesh is asked again
+# in the background, '' disables it. Older snapshots are ignored (seconds).
+DISCOVERY_SNAPSHOT_PATH = 'discovery.json'
+DISCOVERY_SNAPSHOT_MAX_AGE = 86400
+
+# Gzip JSON responses of at least RESPONSE_GZIP_MIN_SIZE bytes for clients that accept it
+RESPONSE_GZIP_ENABLED = True
+RESPONSE_GZIP_MIN_SIZE = 1024
+RESPONSE_GZIP_LEVEL = 5
+
+# Where OAuth tokens live: "sqlite" (safe with several worker processes), "memory" (dict + append-only
+# journal, single process only) or "tinydb" (tokens table in DATABASE_PATH). Tokens from DATABASE_PATH are
+# imported the first time the sqlite or memory store is created.
+TOKEN_STORE_BACKEND = "sqlite"
+# SQLite database of the "sqlite" backend and append-only journal of the "memory" backend, the formats differ
+TOKEN_STORE_PATH = 'tokens.db'
+TOKEN_JOURNAL_PATH = 'tokens.jsonl'
+# Expired authorization codes are purged at most this often (seconds)
+TOKEN_PURGE_INTERVAL = 60
+
+# How many bearer tokens keep their resolved user in memory
+PRINCIPAL_CACHE_SIZE = 4096
+# Seconds a cached token stays valid without checking the token store again
+PRINCIPAL_CACHE_TTL = 60
+
+# bcrypt work factor for new and rehashed passwords, hashes with another cost are upgraded on login
+BCRYPT_ROUNDS = 12
+# Processes verifying passwords, None means one per CPU core
+PASSWORD_WORKERS = None
+PASSWORD_VERIFY_TIMEOUT = 10
+# Failed logins allowed per username and per client address inside the window (seconds), counted in each worker
+# process separately
+LOGIN_MAX_ATTEMPTS = 5
+LOGIN_ATTEMPT_WINDOW = 300
+
+# Production serving (gunicorn -c gunicorn.conf.py wsgi:app): worker processes and threads per worker.
+# Mesh I/O mostly waits, so threads are cheap; add workers to use more CPU cores.
+SERVER_WORKERS = 2
+SERVER_THREADS = 16
+# Only one worker process (the first to start) talks to the Khawasu mesh: discovery, state subscriptions and
+# device calls. The other workers reach its registry and states over this Unix socket, and one of them takes over
+# when it exits. '' makes every worker talk to the mesh itself. A file name without a directory is put in a private
+# runtime directory ($XDG_RUNTIME_DIR/khawasu or khawasu-<uid> in the temp directory), the directory of a full path
+# must not be writable by other users. Workers authenticate with a random key kept in <socket>.key (mode 600)
+MESH_OWNER_ADDRESS = 'khawasu-mesh.sock'
+# Seconds a starting worker waits for the owner's socket
+MESH_OWNER_CONNECT_TIMEOUT = 5
+
+# Connections to the Khawasu logical adapter, requests are spread over them (each carries many at once)
+KHAWASU_POOL_SIZE = 4
+# Reconnect delay after a failed connect (seconds), doubled on every failure up to the maximum
+KHAWASU_RECONNECT_BACKOFF = 1
+KHAWASU_RECONNECT_BACKOFF_MAX = 30
+# Seconds an action_get answer is reused for identical requests, 0 only merges requests in flight
+KHAWASU_ACTION_GET_TTL = 0
+# Seconds to wait for the answer to an action_get and to the device list (the driver itself waits 15)
+KHAWASU_REQUEST_TIMEOUT = 2
+KHAWASU_DISCOVERY_TIMEOUT = 15
+# After this many unanswered action_gets in a row a device is reported unreachable without asking it
+# for KHAWASU_CIRCUIT_OPEN_SECONDS, then one request probes it again
+KHAWASU_CIRCUIT_FAILURES = 3
+KHAWASU_CIRCUIT_OPEN_SECONDS = 30
+
+# Acknowledge /devices/action at once and execute in the background, reporting results to the callback API
+ACTION_ASYNC_MODE = False
+ACTION_QUEUE_WORKERS = 4
+
+# Yandex notification API: https://yandex.ru/dev/dialogs/smart-home/doc/reference-alerts/resources-alerts.html
+# Point YANDEX_CALLBACK_URL to a local stub server for testing, empty disables callbacks
+YANDEX_SKILL_ID = ""
+YANDEX_OAUTH_TOKEN = ""
+YANDEX_CALLBACK_URL = "https://dialogs.yandex.net/api/v1/skills/{skill_id}/callback/state"
+YANDEX_CALLBACK_TIMEOUT = 5
+
+# Push state changes from subscriptions to the callback API and mark capabilities reportable
+# (needs STATE_CACHE_ENABLED and YANDEX_CALLBACK_URL, without them nothing is reported)
+STATE_REPORTING_ENABLED = False
+# Changes are collected for REPORT_DEBOUNCE seconds and sent REPORT_BATCH_SIZE devices per request
+REPORT_DEBOUNCE = 0.5
+REPORT_BATCH_SIZE = 100
+# Changed actions kept while the callback API is failing, oldest are dropped first
+REPORT_MAX_PENDING = 10000
+REPORT_RETRY_BACKOFF = 1
+REPORT_RETRY_BACKOFF_MAX = 60
+
+# Log records are written by a background thread, LOG_FORMAT is "text" (key=value) or "json"
+LOG_LEVEL = "INFO"
+LOG_FORMAT = "text"
+
+# Prometheus text format on /metrics (timings of routes, Khawasu calls, TinyDB and bcrypt), expose it internally only
+METRICS_ENABLED = True
+# Scrapers send it as a bearer token, /metrics is not served while it is empty
+METRICS_TOKEN = ""
+# Every worker leaves its values here each METRICS_DUMP_INTERVAL seconds and /metrics adds them up,
+# empty serves only the values of the worker answering the scrape. gunicorn clears it on start
+METRICS_DIR = "metrics"
+METRICS_DUMP_INTERVAL = 5
+# Share of requests run under cProfile, their stats are dumped to PROFILE_DIR (0 disables, 1 profiles every request)
+PROFILE_SAMPLE_RATE = 0.0
+PROFILE_DIR = "profiles"
+
+# Users only see and control devices granted to them in the "ownership" table of DATABASE_PATH
+# (see common/ownership.py), when disabled every user sees the whole mesh
+DEVICE_OWNERSHIP_ENABLED = False
+# Seconds before grants are read again, so changes made by other processes show up
+OWNERSHIP_RELOAD_INTERVAL = 30
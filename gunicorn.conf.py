@@ -0,0 +1,27 @@
+# "config" is a gunicorn setting name itself, so take only the values from the skill config
+from config import METRICS_DIR, SERVER_HOST, SERVER_PORT, SERVER_THREADS, SERVER_WORKERS
+from common import runtime
+from common.metrics import clear_dumps
+
+bind = f"{SERVER_HOST}:{SERVER_PORT}"
+workers = SERVER_WORKERS
+threads = SERVER_THREADS
+worker_class = "gthread"
+
+# Every worker has to import the app itself: the Khawasu driver socket, thread pools and background
+# threads can not survive fork, so they are created per worker by create_app()
+preload_app = False
+
+# Requests wait on mesh round trips, give them more time than the default 30 seconds
+timeout = 60
+graceful_timeout = 30
+
+
+def on_starting(server):
+    # Counters left by workers of the previous run would be added to the new ones
+    if METRICS_DIR:
+        clear_dumps(METRICS_DIR)
+
+
+def worker_exit(server, worker):
+    runtime.shutdown()
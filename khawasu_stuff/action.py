@@ -1,6 +1,10 @@
+import struct
+import sys
 from enum import Enum
 from typing import Any
 
+_UINT16 = struct.Struct("<H")
+
 
 class ActionType(Enum):
     UNKNOWN = 0
@@ -12,55 +16,106 @@ class ActionType(Enum):
     HUMIDITY = 6
 
 
-class Action:
-    def __init__(self, name: str, type: int):
-        self.name = name
-        self.type = ActionType(type)
+# Row bytes (IMMEDIATE), does not matter (LABEL) or sent as is (TEMPERATURE, HUMIDITY)
+def _encode_byte(data: Any) -> bytes:
+    return bytes([data])
 
-    def format_args_to_bytes(self, data: Any):
-        # Row bytes
-        if self.type == ActionType.IMMEDIATE:
-            return bytes([data])
 
-        # 1 or 0
-        if self.type == ActionType.TOGGLE:
-            return bytes([int(bool(data))])
+# 1 or 0
+def _encode_toggle(data: Any) -> bytes:
+    return bytes([int(bool(data))])
 
-        # byte from 0 to 255
-        if self.type == ActionType.RANGE:
-            return bytes([int(float(data) * 255)])
 
-        # Does not matter
-        if self.type == ActionType.LABEL:
-            return bytes([data])
+# byte from 0 to 255
+def _encode_range(data: Any) -> bytes:
+    return bytes([int(float(data) * 255)])
 
-        if self.type == ActionType.TEMPERATURE:
-            return bytes([data])
 
-        if self.type == ActionType.HUMIDITY:
-            return bytes([data])
+# Row bytes
+def _decode_raw(row_data: bytes) -> Any:
+    return row_data
 
-        raise NotImplementedError(str(self.type))
 
-    def format_bytes_to_data(self, row_data: bytes) -> Any:
-        # Row bytes
-        if self.type == ActionType.IMMEDIATE:
-            return row_data
+# Bool value
+def _decode_toggle(row_data: bytes) -> bool:
+    return bool(row_data[0] if len(row_data) > 0 else 0)
+
+
+# float from 0 to 1
+def _decode_range(row_data: bytes) -> float:
+    return (row_data[0] if len(row_data) > 0 else 0) / 255
+
+
+# Temperature and humidity percent: unsigned 8.8 fixed point (float)
+def _decode_fixed_8_8(row_data: bytes) -> float:
+    return (_UINT16.unpack_from(row_data)[0] if len(row_data) >= 2 else 0) / 256
+
+
+ENCODERS = {
+    ActionType.IMMEDIATE: _encode_byte,
+    ActionType.TOGGLE: _encode_toggle,
+    ActionType.RANGE: _encode_range,
+    ActionType.LABEL: _encode_byte,
+    ActionType.TEMPERATURE: _encode_byte,
+    ActionType.HUMIDITY: _encode_byte,
+}
+
+DECODERS = {
+    ActionType.IMMEDIATE: _decode_raw,
+    ActionType.TOGGLE: _decode_toggle,
+    ActionType.RANGE: _decode_range,
+    ActionType.TEMPERATURE: _decode_fixed_8_8,
+    ActionType.HUMIDITY: _decode_fixed_8_8,
+}
+
+# Record layout of types which can be decoded straight from a packed buffer
+PACKED_FORMATS = {
+    ActionType.TOGGLE: (struct.Struct("<B"), bool),
+    ActionType.RANGE: (struct.Struct("<B"), lambda value: value / 255),
+    ActionType.TEMPERATURE: (_UINT16, lambda value: value / 256),
+    ActionType.HUMIDITY: (_UINT16, lambda value: value / 256),
+}
 
-        # Bool value
-        if self.type == ActionType.TOGGLE:
-            return bool(row_data[0] if len(row_data) > 0 else 0)
 
-        # float from 0 to 1
-        if self.type == ActionType.RANGE:
-            return int.from_bytes(row_data[:1], byteorder='little') / 255
+def decode_packed(action_type: ActionType, buffer: bytes) -> list:
+    """ Decodes a buffer of back to back fixed size values of one type without copying it """
+    if action_type not in PACKED_FORMATS:
+        raise NotImplementedError(str(action_type))
+
+    record, convert = PACKED_FORMATS[action_type]
+    view = memoryview(buffer)
+    return [convert(value) for value, in record.iter_unpack(view[:len(view) - len(view) % record.size])]
+
+
+class Action:
+    __slots__ = ("name", "type", "encoder", "decoder")
+
+    def __init__(self, name: str, type: int):
+        self.name = sys.intern(name)
+        self.type = ActionType(type)
+        self.encoder = ENCODERS.get(self.type)
+        self.decoder = DECODERS.get(self.type)
+
+    def format_args_to_bytes(self, data: Any):
+        if self.encoder is None:
+            raise NotImplementedError(str(self.type))
+
+        return self.encoder(data)
+
+    def format_bytes_to_data(self, row_data: bytes) -> Any:
+        if self.decoder is None:
+            raise NotImplementedError(str(self.type))
+
+        return self.decoder(row_data)
 
-        # Temperature (float)
-        if self.type == ActionType.TEMPERATURE:
-            return int.from_bytes(row_data[:2] if len(row_data) >= 2 else bytes(2), byteorder='little') / 256
+    def format_many_bytes_to_data(self, payloads: list[bytes]) -> list:
+        """ format_bytes_to_data of every payload, fixed size values are unpacked in one pass """
+        if self.decoder is None:
+            raise NotImplementedError(str(self.type))
 
-        # Humidity percent (float)
-        if self.type == ActionType.HUMIDITY:
-            return int.from_bytes(row_data[:2] if len(row_data) >= 2 else bytes(2), byteorder='little') / 256
+        packed = PACKED_FORMATS.get(self.type)
+        if packed is not None and all(len(row_data) == packed[0].size for row_data in payloads):
+            return decode_packed(self.type, b"".join(payloads))
 
-        raise NotImplementedError(str(self.type))
+        decoder = self.decoder
+        return [decoder(row_data) for row_data in payloads]
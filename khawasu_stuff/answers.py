@@ -0,0 +1,54 @@
+import asyncio
+import functools
+
+from khawasu_stuff import transport
+
+
+class AnswerWaiter:
+    """
+        Resolves asyncio futures when the answers to their request ids come in (see transport).
+        The driver socket thread wakes the event loop of the waiting future for each answer it stores,
+        so waiting holds no thread and nothing runs while no answer comes.
+    """
+
+    def __init__(self):
+        # (connection, request id) -> future
+        self.waiting = {}
+
+    def watch(self, inst):
+        """ Called once for each new connection, before requests are waited for on it """
+        transport.watch_answers(inst, functools.partial(self.on_answer, inst))
+
+    def on_answer(self, inst, request_id: int):
+        # Runs in the driver socket thread, an exception here would end it
+        future = self.waiting.get((inst, request_id))
+        if future is None:
+            return
+
+        try:
+            future.get_loop().call_soon_threadsafe(self.resolve, inst, request_id)
+        except RuntimeError:
+            # The event loop is closed
+            pass
+
+    def resolve(self, inst, request_id: int):
+        future = self.waiting.get((inst, request_id))
+        # Cancelled by a timeout, the caller deals with a late answer
+        if future is None or future.done() or not transport.has_answer(inst, request_id):
+            return
+
+        del self.waiting[(inst, request_id)]
+        future.set_result(transport.pop_answer(inst, request_id))
+
+    def forget(self, key: tuple, future: asyncio.Future):
+        if self.waiting.get(key) is future:
+            del self.waiting[key]
+
+    def wait(self, inst, request_id: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[(inst, request_id)] = future
+        future.add_done_callback(functools.partial(self.forget, (inst, request_id)))
+
+        # The answer may have come in before anybody waited for it
+        self.resolve(inst, request_id)
+        return future
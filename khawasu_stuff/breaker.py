@@ -0,0 +1,85 @@
+import threading
+import time
+from typing import Hashable
+
+
+class CircuitOpenError(ConnectionError):
+    def __init__(self, key: Hashable, retry_after: float):
+        super().__init__(f"{key} is not responding, next try in {max(retry_after, 0):.0f} s")
+        self.key = key
+        self.retry_after = retry_after
+
+    def __reduce__(self):
+        # Sent between worker processes, the default would call __init__ with the message only
+        return type(self), (self.key, self.retry_after)
+
+
+class CircuitBreaker:
+    """
+        Per key (device address) health: after failure_threshold failures in a row the circuit opens and calls
+        fail at once for open_seconds. Then one call is let through as a probe (half-open): its success closes
+        the circuit, its failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int, open_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.lock = threading.Lock()
+        # key -> [failures in a row, open until, probe started at]
+        self.states = {}
+
+    def before_call(self, key: Hashable):
+        """ Raises CircuitOpenError unless the call may go out, the caller must then report its outcome """
+        if key not in self.states:
+            return
+
+        now = time.monotonic()
+        with self.lock:
+            state = self.states.get(key)
+            if state is None or state[1] == 0:
+                return
+
+            if now < state[1]:
+                raise CircuitOpenError(key, state[1] - now)
+
+            # Half-open: one probe at a time, a probe that never reported is replaced after open_seconds
+            if state[2] and now - state[2] < self.open_seconds:
+                raise CircuitOpenError(key, state[2] + self.open_seconds - now)
+
+            state[2] = now
+
+    def check(self, key: Hashable):
+        """ Raises CircuitOpenError while the circuit is open, for calls whose outcome is unknown """
+        state = self.states.get(key)
+        if state is not None and state[1] != 0:
+            retry_after = state[1] - time.monotonic()
+            if retry_after > 0:
+                raise CircuitOpenError(key, retry_after)
+
+    def is_open(self, key: Hashable) -> bool:
+        state = self.states.get(key)
+        return state is not None and state[1] != 0 and time.monotonic() < state[1]
+
+    def record_success(self, key: Hashable):
+        if key in self.states:
+            with self.lock:
+                self.states.pop(key, None)
+
+    def record_failure(self, key: Hashable):
+        with self.lock:
+            state = self.states.setdefault(key, [0, 0, 0])
+            state[0] += 1
+            # A failed probe opens the circuit again at once
+            if state[0] >= self.failure_threshold or state[1] != 0:
+                state[1] = time.monotonic() + self.open_seconds
+                state[2] = 0
+
+    def record_cancel(self, key: Hashable):
+        """ The caller gave up before the outcome was known, a probe it started is no longer waited for """
+        state = self.states.get(key)
+        if state is not None and state[2]:
+            with self.lock:
+                state[2] = 0
+
+    def open_keys(self) -> list:
+        return [key for key in list(self.states) if self.is_open(key)]
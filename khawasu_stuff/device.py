@@ -1,10 +1,19 @@
 from __future__ import annotations
+
+import asyncio
+import logging
+import sys
+import threading
 from enum import Enum
 from typing import Any
 
-import driver_khawasu.driver
-
 from khawasu_stuff.action import Action, ActionType
+from khawasu_stuff.pool import DriverPool
+
+log = logging.getLogger(__name__)
+
+_update_decoder = None
+_update_decoder_lock = threading.Lock()
 
 
 class DeviceType(Enum):
@@ -19,87 +28,232 @@ class DeviceType(Enum):
     LED_1_DIM = 8
 
 
-_khawasu_devices_cache = None
-
-
 class Device:
-    def __init__(self, row, khawasu_inst: driver_khawasu.driver.LogicalDriver):
-        self.actions = [Action(name, type) for name, type in row["actions"].items()]
+    __slots__ = ("actions_by_name", "address", "attribs", "dev_class", "type", "group", "name", "khawasu_pool")
+
+    def __init__(self, row, khawasu_pool: DriverPool | None):
+        self.actions_by_name = {action.name: action for action in
+                                (Action(name, type) for name, type in row["actions"].items())}
         self.address = row["address"]
         self.attribs = row["attribs"]
         self.dev_class = row["dev_class"]
         self.type = DeviceType(int(self.dev_class))
-        self.group = row["group_name"]
+        # Many devices share a room, keep one copy of its name
+        self.group = sys.intern(row["group_name"])
         self.name = row["name"]
-        self.khawasu_inst = khawasu_inst
+        self.khawasu_pool = khawasu_pool
+
+    @property
+    def actions(self) -> list[Action]:
+        return list(self.actions_by_name.values())
+
+    def to_row(self) -> dict:
+        """ The list-devices row of this device, rebuilt when asked for instead of kept around """
+        return {"address": self.address, "attribs": self.attribs, "dev_class": self.dev_class,
+                "group_name": self.group, "name": self.name,
+                "actions": {action.name: action.type.value for action in self.actions_by_name.values()}}
+
+    def matches(self, row: dict) -> bool:
+        """ True if row would build the same device, fields the device does not keep are not compared """
+        return all(row.get(key) == value for key, value in self.to_row().items())
 
     def execute(self, action_name: str, data: Any) -> bool:
-        for action in self.actions:
-            if action.name != action_name:
-                continue
+        action = self.actions_by_name.get(action_name)
+        if action is None:
+            return False
 
-            # cast from [0, 100] to [0, 1] for yandex
-            if action.type == ActionType.RANGE:
-                data /= 100
+        # cast from [0, 100] to [0, 1] for yandex
+        if action.type == ActionType.RANGE:
+            data /= 100
 
-            self.khawasu_inst.execute(self.address, action_name, action.format_args_to_bytes(data))
-            return True
+        # Execute is not answered, so it can not probe the device, only an open circuit stops it
+        self.khawasu_pool.breaker.check(self.address)
 
-        return False
+        with self.khawasu_pool.timed("execute", self.type.name, action.type.name), \
+                self.khawasu_pool.checkout() as khawasu_inst:
+            khawasu_inst.execute(self.address, action_name, action.format_args_to_bytes(data))
 
-    def get(self, action_name: str) -> Any:
-        for action in self.actions:
-            if action.name != action_name:
-                continue
-            data = self.khawasu_inst.action_get(self.address, action_name)
+        self.khawasu_pool.action_get_flight.forget((self.address, action_name))
+        return True
+
+    def decode(self, action: Action, data: dict) -> Any:
+        return self.decode_many(action, [data])[0]
 
+    def decode_many(self, action: Action, messages: list[dict]) -> list:
+        """ decode of many answers of one action type, their payloads are decoded in one batch """
+        payloads = []
+        for data in messages:
             if "status" in data:
-                print("Error in action fetch: ", data["status"])
-                return None
+                log.warning("Error in action fetch: %s", data["status"], extra={"address": self.address})
+            else:
+                payloads.append(data["data"])
+
+        decoded = iter(action.format_many_bytes_to_data(payloads) if payloads else ())
+        results = [None if "status" in data else next(decoded) for data in messages]
+
+        # cast from [0, 1] to [0, 100] for yandex
+        if action.type == ActionType.RANGE:
+            results = [None if result is None else result * 100 for result in results]
+
+        return results
+
+    def get(self, action_name: str) -> Any:
+        action = self.actions_by_name.get(action_name)
+        if action is None:
+            return None
+
+        def fetch():
+            try:
+                with self.khawasu_pool.timed("action_get", self.type.name, action.type.name):
+                    data = self.khawasu_pool.get("action_fetch", {"action_name": action_name, "address": self.address})
+            except TimeoutError:
+                # Other errors are about the connection to the adapter, not about this device
+                self.khawasu_pool.breaker.record_failure(self.address)
+                raise
+
+            self.khawasu_pool.breaker.record_success(self.address)
+            return data
+
+        # A device which stopped answering fails at once instead of costing every caller a timeout
+        self.khawasu_pool.breaker.before_call(self.address)
+
+        # Concurrent gets of the same action share one round trip
+        return self.decode(action, self.khawasu_pool.action_get_flight.do((self.address, action_name), fetch))
 
-            result = action.format_bytes_to_data(data["data"])
+    async def get_async(self, action_name: str) -> Any:
+        """ get for the event loop, concurrent calls are not merged """
+        action = self.actions_by_name.get(action_name)
+        if action is None:
+            return None
 
-            # cast from [0, 1] to [0, 100] for yandex
-            if action.type == ActionType.RANGE:
-                result *= 100
+        self.khawasu_pool.breaker.before_call(self.address)
 
-            return result
+        try:
+            with self.khawasu_pool.timed("action_get", self.type.name, action.type.name):
+                data = await self.khawasu_pool.get_async("action_fetch", {"action_name": action_name,
+                                                                          "address": self.address})
+        except TimeoutError:
+            self.khawasu_pool.breaker.record_failure(self.address)
+            raise
+        except asyncio.CancelledError:
+            # Nothing was learned about the device, the next call may probe it
+            self.khawasu_pool.breaker.record_cancel(self.address)
+            raise
 
-        return None
+        self.khawasu_pool.breaker.record_success(self.address)
+        return self.decode(action, data)
 
     """ 
         period - for regularly updated devices: how often updated info will be sent. (in milliseconds)
         duration - subscription time (in seconds)
+        handler - called from the update decoder thread as handler(address, action_name, decoded_value)
     """
 
-    def subscribe(self, action_name: str, period: int, duration: int, handler) -> Any:
-        for action in self.actions:
-            if action != action_name:
-                continue
+    def subscribe(self, action_name: str, period: int, duration: int, handler) -> bool:
+        action = self.actions_by_name.get(action_name)
+        if action is None:
+            return False
 
-            self.khawasu_inst.subscribe(self.address, action_name, period, duration, handler)
+        def on_message(address, method_name, msg):
+            # The driver socket thread only queues the update, it is decoded with the others that came meanwhile
+            update_decoder().put(self, action, handler, msg.get("data", {}))
 
+        if self.khawasu_pool.breaker.is_open(self.address):
             return False
 
-        return True
+        with self.khawasu_pool.timed("subscribe", self.type.name, action.type.name):
+            return self.khawasu_pool.subscribe(self.address, action_name, period, duration, on_message)
 
     @classmethod
-    def get_by_address(cls, khawasu_inst: driver_khawasu.driver.LogicalDriver, address: str) -> Device | None:
-        global _khawasu_devices_cache
-
+    def get_by_address(cls, khawasu_pool: DriverPool, address: str) -> Device | None:
         # Trigger for update
-        if _khawasu_devices_cache is None:
-            cls.get_all(khawasu_inst)
+        if not khawasu_pool.devices:
+            cls.get_all(khawasu_pool)
 
-        for dev in _khawasu_devices_cache:
-            if dev.address == address:
-                return dev
-
-        return None
+        return khawasu_pool.devices.get(address)
 
     @classmethod
-    def get_all(cls, khawasu_inst: driver_khawasu.driver.LogicalDriver) -> list[Device]:
-        global _khawasu_devices_cache
-        _khawasu_devices_cache = [cls(dev, khawasu_inst) for dev in khawasu_inst.get("list-devices")]
+    def get_all(cls, khawasu_pool: DriverPool) -> list[Device]:
+        """ Devices of the pool's gateway, remembered in khawasu_pool.devices """
+        previous = khawasu_pool.devices
+
+        with khawasu_pool.timed("list-devices"):
+            rows = khawasu_pool.get("list-devices", timeout=khawasu_pool.discovery_timeout)
+
+        # Devices which did not change since the last call are kept as the same objects
+        devices = []
+        for row in rows:
+            dev = previous.get(row["address"])
+            devices.append(dev if dev is not None and dev.matches(row) else cls(row, khawasu_pool))
+
+        khawasu_pool.devices = {dev.address: dev for dev in devices}
+
+        return devices
+
+
+class UpdateDecoder:
+    """
+        Decodes subscription updates off the driver socket threads and hands them to their handlers in order.
+        Updates which arrive while the previous ones are handled are decoded together, one batch per action type.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        # (device, action, handler, data) in arrival order
+        self.pending = []
+        self.thread = threading.Thread(target=self.run, name="subscription-updates", daemon=True)
+        self.thread.start()
+
+    def put(self, device: Device, action: Action, handler, data: dict):
+        with self.cond:
+            self.pending.append((device, action, handler, data))
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                updates, self.pending = self.pending, []
+
+            self.handle(updates)
+
+    @staticmethod
+    def handle(updates: list[tuple]):
+        # A value depends on the action type only, errors are logged with their device
+        values = [None] * len(updates)
+        by_type = {}
+        for index, (device, action, _, data) in enumerate(updates):
+            if "status" in data:
+                values[index] = device.decode(action, data)
+            else:
+                by_type.setdefault(action.type, []).append(index)
+
+        for indexes in by_type.values():
+            device, action = updates[indexes[0]][:2]
+            try:
+                decoded = device.decode_many(action, [updates[index][3] for index in indexes])
+            except Exception as ex:
+                # Handlers of a malformed batch get None, the decoder thread must go on
+                log.warning("Error in subscription update: %r", ex, extra={"address": device.address})
+                continue
+
+            for index, value in zip(indexes, decoded):
+                values[index] = value
+
+        for (device, action, handler, _), value in zip(updates, values):
+            try:
+                handler(device.address, action.name, value)
+            except Exception:
+                log.exception("Error in subscription handler", extra={"address": device.address})
+
+
+def update_decoder() -> UpdateDecoder:
+    global _update_decoder
+    if _update_decoder is None:
+        # Subscriptions of several connections are made together, their updates must share one thread
+        with _update_decoder_lock:
+            if _update_decoder is None:
+                _update_decoder = UpdateDecoder()
 
-        return _khawasu_devices_cache
+    return _update_decoder
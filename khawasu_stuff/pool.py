@@ -0,0 +1,315 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import driver_khawasu.driver
+
+from khawasu_stuff import transport
+from khawasu_stuff.answers import AnswerWaiter
+from khawasu_stuff.breaker import CircuitBreaker
+from khawasu_stuff.singleflight import SingleFlight
+
+log = logging.getLogger(__name__)
+
+
+class DriverPool:
+    """
+        Pool of LogicalDriver connections. A LogicalDriver matches answers to requests by id, so one connection
+        carries many requests at once: checkouts are spread round-robin instead of being exclusive.
+        Connections are created on demand up to size (in the background while there is one to use already),
+        broken ones are dropped and reconnection attempts are spaced with exponential backoff.
+    """
+
+    # Answer polling interval of get(), grows from min to max while waiting (seconds)
+    POLL_INTERVAL_MIN = 0.0005
+    POLL_INTERVAL_MAX = 0.005
+    # Ids of timed out requests are kept this long to remove their late answers (seconds)
+    ABANDONED_TTL = 60
+
+    def __init__(self, factory, size: int, backoff: float, backoff_max: float, timeout: float = 15,
+                 discovery_timeout: float = 15, name: str = "", action_get_ttl: float = 0, circuit_failures: int = 3,
+                 circuit_open_seconds: float = 30):
+        self.factory = factory
+        self.name = name
+        self.size = size
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        # Answer deadlines of get() and of the device list (seconds)
+        self.timeout = timeout
+        self.discovery_timeout = discovery_timeout
+
+        self.lock = threading.Lock()
+        # Notified when a connection attempt ends
+        self.connect_done = threading.Condition(self.lock)
+        self.connections = []
+        self.connecting = 0
+        self.closed = False
+        self.next_index = 0
+        self.failures = 0
+        self.next_connect_time = 0
+
+        # Shared by all devices using this pool, keyed by (address, action_name)
+        self.action_get_flight = SingleFlight(action_get_ttl)
+        # Shared by all devices using this pool, keyed by address
+        self.breaker = CircuitBreaker(circuit_failures, circuit_open_seconds)
+        # connection -> {request id: time it timed out}
+        self.abandoned = {}
+        # Devices found on this gateway by the last discovery, keyed by address
+        self.devices = {}
+        # Waits for answers of get_async
+        self.answer_waiter = AnswerWaiter()
+
+        # Called as observer(call, device_type, action_type, seconds, ok) after every timed driver call
+        self.observer = None
+
+    def close_and_forget(self, inst: driver_khawasu.driver.LogicalDriver):
+        self.abandoned.pop(inst, None)
+        transport.close(inst)
+
+    def connect(self):
+        """
+            Opens one connection reserved by acquire (self.connecting). Runs without self.lock: the factory blocks
+            on the socket connect and the version handshake, checkouts of other connections go on meanwhile.
+        """
+        try:
+            inst = self.factory()
+        except Exception:
+            with self.lock:
+                self.connecting -= 1
+                self.failures += 1
+                self.next_connect_time = time.time() + min(self.backoff * 2 ** (self.failures - 1), self.backoff_max)
+                self.connect_done.notify_all()
+            raise
+
+        if transport.can_split(inst):
+            self.answer_waiter.watch(inst)
+
+        with self.lock:
+            self.connecting -= 1
+            self.failures = 0
+            closed = self.closed
+            if not closed:
+                self.connections.append(inst)
+            self.connect_done.notify_all()
+
+        if closed:
+            transport.close(inst)
+
+    def connect_in_background(self):
+        try:
+            self.connect()
+        except Exception as ex:
+            log.warning("Error in Khawasu connect: %r", ex, extra={"gateway": self.name})
+
+    def next_connection(self) -> driver_khawasu.driver.LogicalDriver:
+        # Called with self.lock held and at least one connection
+        self.next_index = (self.next_index + 1) % len(self.connections)
+        return self.connections[self.next_index]
+
+    def acquire(self, connect: bool = True) -> driver_khawasu.driver.LogicalDriver | None:
+        """ With connect=False None is returned instead of waiting for a connection to be opened """
+        with self.lock:
+            for inst in [inst for inst in self.connections if not transport.is_healthy(inst)]:
+                log.warning("Dropping broken Khawasu connection", extra={"gateway": self.name})
+                self.connections.remove(inst)
+                self.close_and_forget(inst)
+
+            grow = len(self.connections) + self.connecting < self.size and time.time() >= self.next_connect_time
+            if self.connections:
+                if grow:
+                    # Keep serving through the connections we have while another one opens
+                    self.connecting += 1
+                    threading.Thread(target=self.connect_in_background, name="khawasu-connect", daemon=True).start()
+                return self.next_connection()
+
+            if not connect:
+                return None
+
+            if self.connecting or not grow:
+                # Someone else is opening the first connection, or the backoff is not over yet
+                self.connect_done.wait_for(lambda: self.connections or not self.connecting)
+                if not self.connections:
+                    raise ConnectionError("Khawasu is unreachable, waiting before the next reconnect")
+                return self.next_connection()
+
+            self.connecting += 1
+
+        self.connect()
+
+        with self.lock:
+            if not self.connections:
+                raise ConnectionError("Khawasu connection was dropped right after connecting")
+            return self.next_connection()
+
+    def release(self, inst: driver_khawasu.driver.LogicalDriver):
+        # A dead socket thread means the connection is gone, timeouts of single calls are fine
+        if not transport.is_healthy(inst):
+            with self.lock:
+                if inst in self.connections:
+                    self.connections.remove(inst)
+                self.close_and_forget(inst)
+
+    @contextmanager
+    def checkout(self):
+        inst = self.acquire()
+        try:
+            yield inst
+        finally:
+            self.release(inst)
+
+    def get(self, method_name: str, args: dict = None, timeout: float = None):
+        """
+            LogicalDriver.get with its own deadline: the driver spins on the CPU for 15 s waiting for an answer,
+            here the answer is polled with short sleeps and TimeoutError is raised after timeout seconds.
+        """
+        timeout = self.timeout if timeout is None else timeout
+
+        with self.checkout() as inst:
+            if not transport.can_split(inst):
+                # Waits the way the driver does
+                return inst.get(method_name, args)
+
+            return self.request(inst, method_name, args, timeout)
+
+    def request(self, inst: driver_khawasu.driver.LogicalDriver, method_name: str, args: dict, timeout: float):
+        """ Sends a request on a connection which can split and polls for its answer until timeout """
+        request_id = transport.send_request(inst, method_name, args, timeout)
+
+        deadline = time.monotonic() + timeout
+        interval = self.POLL_INTERVAL_MIN
+        while not transport.has_answer(inst, request_id):
+            if time.monotonic() >= deadline:
+                self.abandon(inst, request_id)
+                raise TimeoutError(f"No answer to {method_name} in {timeout} s")
+
+            time.sleep(interval)
+            interval = min(interval * 2, self.POLL_INTERVAL_MAX)
+
+        answer = transport.pop_answer(inst, request_id)
+
+        if self.abandoned.get(inst):
+            self.drop_late_answers(inst)
+
+        return answer
+
+    def subscribe(self, address: str, action_name: str, period: int, duration: int, handler) -> bool:
+        """
+            LogicalDriver.subscribe with the deadline of get. Updates arrive on the connection the subscription
+            was made on, so the handler is registered with that connection.
+        """
+        with self.checkout() as inst:
+            if not transport.can_split(inst):
+                return inst.subscribe(address, action_name, period, duration, handler) is None
+
+            answer = self.request(inst, "action_subscribe_new", {"address": address, "action_name": action_name,
+                                                                 "period": period, "duration": duration},
+                                  self.timeout)
+            if "error" in answer:
+                return False
+
+            transport.add_subscription(inst, answer["id"], address, action_name, handler)
+            return True
+
+    def start_request(self, method_name: str, args: dict, timeout: float) -> tuple:
+        """ (connection, request id) of a sent request, the id is None for a connection which can not split """
+        inst = self.acquire()
+        try:
+            if not transport.can_split(inst):
+                return inst, None
+
+            return inst, transport.send_request(inst, method_name, args, timeout)
+        except BaseException:
+            self.release(inst)
+            raise
+
+    def finish_cancelled(self, started: asyncio.Future):
+        # The caller of get_async is gone, nobody takes the answer of a request sent after that
+        if started.cancelled() or started.exception() is not None:
+            return
+
+        inst, request_id = started.result()
+        if request_id is not None:
+            self.abandon(inst, request_id)
+        self.release(inst)
+
+    async def get_async(self, method_name: str, args: dict = None, timeout: float = None):
+        """ get for the event loop: waiting for the answer holds no thread """
+        timeout = self.timeout if timeout is None else timeout
+
+        # Sent right here if a connection is open and the driver's locks are free, else a thread is borrowed
+        # to open the connection or wait for the locks
+        inst = self.acquire(connect=False)
+        request_id = None
+        if inst is not None and transport.can_split(inst):
+            request_id = transport.try_send_request(inst, method_name, args)
+
+        if request_id is None:
+            if inst is not None:
+                self.release(inst)
+
+            started = asyncio.ensure_future(asyncio.to_thread(self.start_request, method_name, args, timeout))
+            try:
+                inst, request_id = await asyncio.shield(started)
+            except asyncio.CancelledError:
+                started.add_done_callback(self.finish_cancelled)
+                raise
+
+        try:
+            if request_id is None:
+                try:
+                    return await asyncio.wait_for(asyncio.to_thread(inst.get, method_name, args), timeout)
+                except asyncio.TimeoutError:
+                    raise TimeoutError(f"No answer to {method_name} in {timeout} s") from None
+
+            try:
+                answer = await asyncio.wait_for(self.answer_waiter.wait(inst, request_id), timeout)
+            except asyncio.TimeoutError:
+                self.abandon(inst, request_id)
+                raise TimeoutError(f"No answer to {method_name} in {timeout} s") from None
+            except asyncio.CancelledError:
+                # Like a timeout, only the caller's deadline was shorter
+                self.abandon(inst, request_id)
+                raise
+
+            if self.abandoned.get(inst):
+                self.drop_late_answers(inst)
+
+            return answer
+        finally:
+            self.release(inst)
+
+    def abandon(self, inst: driver_khawasu.driver.LogicalDriver, request_id: int):
+        with self.lock:
+            self.abandoned.setdefault(inst, {})[request_id] = time.monotonic()
+
+    def drop_late_answers(self, inst: driver_khawasu.driver.LogicalDriver):
+        # Nobody waits for answers of timed out requests, they would stay in the driver forever
+        now = time.monotonic()
+        with self.lock:
+            abandoned = self.abandoned.get(inst, {})
+            for request_id, abandoned_time in list(abandoned.items()):
+                if transport.discard_answer(inst, request_id) or now - abandoned_time > self.ABANDONED_TTL:
+                    del abandoned[request_id]
+
+    @contextmanager
+    def timed(self, call: str, device_type: str = "", action_type: str = ""):
+        start = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            if self.observer is not None:
+                self.observer(call, device_type, action_type, time.perf_counter() - start, ok)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            connections, self.connections = self.connections, []
+
+        for inst in connections:
+            self.close_and_forget(inst)
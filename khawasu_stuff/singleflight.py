@@ -0,0 +1,60 @@
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Hashable
+
+
+class SingleFlight:
+    """
+        Concurrent calls with the same key share one execution of fn and its result.
+        With ttl > 0 a finished result is also reused for ttl seconds.
+    """
+
+    def __init__(self, ttl: float = 0):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.results = {}
+        # key -> generation, bumped by forget so calls started before it are not reused
+        self.generations = {}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self.lock:
+            if self.ttl > 0 and key in self.results:
+                result, finished_time = self.results[key]
+                if time.time() - finished_time <= self.ttl:
+                    return result
+
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+                generation = self.generations.get(key, 0)
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+        except BaseException as ex:
+            with self.lock:
+                if self.calls.get(key) is future:
+                    del self.calls[key]
+            future.set_exception(ex)
+            raise
+
+        with self.lock:
+            if self.calls.get(key) is future:
+                del self.calls[key]
+            if self.ttl > 0 and self.generations.get(key, 0) == generation:
+                self.results[key] = (result, time.time())
+        future.set_result(result)
+
+        return result
+
+    def forget(self, key: Hashable):
+        """ Calls started before are neither joined nor cached any more, their result may predate a change """
+        with self.lock:
+            self.results.pop(key, None)
+            self.calls.pop(key, None)
+            self.generations[key] = self.generations.get(key, 0) + 1
@@ -0,0 +1,107 @@
+"""
+    The parts of driver_khawasu.driver.LogicalDriver the pool relies on beyond its public methods, kept in one place.
+    LogicalDriver.get sends a request and spins until the answer is in incoming_packets, the pool does the same
+    two steps itself to wait with its own deadline or on the event loop. A driver without these internals
+    (can_split returns False) is used through its public get instead.
+"""
+from __future__ import annotations
+
+import logging
+
+import driver_khawasu.driver
+
+log = logging.getLogger(__name__)
+
+
+def can_split(inst: driver_khawasu.driver.LogicalDriver) -> bool:
+    """ True if requests can be sent and answered separately on this connection """
+    return all(hasattr(inst, name) for name in ("sem_idx", "idx_buf", "incoming_packets"))
+
+
+def send_request(inst: driver_khawasu.driver.LogicalDriver, method_name: str, args: dict, timeout: float) -> int:
+    """ The same steps as LogicalDriver.get before it starts waiting, returns the request id """
+    if not inst.sem_idx.acquire(timeout=timeout):
+        raise IOError("Semaphore not released")
+    inst.idx_buf += 1
+    request_id = inst.idx_buf
+    inst.sem_idx.release()
+
+    inst.send(method_name, {} if args is None else args, request_id)
+    return request_id
+
+
+def try_send_request(inst: driver_khawasu.driver.LogicalDriver, method_name: str, args: dict) -> int | None:
+    """ send_request for the event loop: None instead of waiting while another thread holds a driver lock """
+    if not inst.sem_idx.acquire(blocking=False):
+        return None
+
+    sem_out_packets = getattr(inst, "sem_out_packets", None)
+    if sem_out_packets is not None and not sem_out_packets.acquire(blocking=False):
+        inst.sem_idx.release()
+        return None
+
+    try:
+        inst.idx_buf += 1
+        request_id = inst.idx_buf
+        if sem_out_packets is None:
+            # No outgoing lock to wait for
+            inst.send(method_name, {} if args is None else args, request_id)
+        else:
+            # LogicalDriver.send with its lock already taken
+            inst.outcoming_packets.append({"method_name": method_name, "data": {} if args is None else args,
+                                           "id": request_id})
+    finally:
+        if sem_out_packets is not None:
+            sem_out_packets.release()
+        inst.sem_idx.release()
+
+    return request_id
+
+
+def has_answer(inst: driver_khawasu.driver.LogicalDriver, request_id: int) -> bool:
+    return request_id in inst.incoming_packets
+
+
+def pop_answer(inst: driver_khawasu.driver.LogicalDriver, request_id: int):
+    """ Data of the answer to request_id, which has_answer found, the answer is removed from the driver """
+    return inst.incoming_packets.pop(request_id)["data"]
+
+
+class WatchedPackets(dict):
+    """ incoming_packets which calls on_answer(request_id) for every answer the driver stores """
+
+    def __init__(self, packets: dict, on_answer):
+        super().__init__(packets)
+        self.on_answer = on_answer
+
+    def __setitem__(self, request_id, packet):
+        super().__setitem__(request_id, packet)
+        self.on_answer(request_id)
+
+
+def watch_answers(inst: driver_khawasu.driver.LogicalDriver, on_answer):
+    """ on_answer(request_id) is called from the driver socket thread as each answer comes in """
+    inst.incoming_packets = WatchedPackets(inst.incoming_packets, on_answer)
+
+
+def discard_answer(inst: driver_khawasu.driver.LogicalDriver, request_id: int) -> bool:
+    """ Removes a late answer nobody waits for, False if it did not come (yet) """
+    return inst.incoming_packets.pop(request_id, None) is not None
+
+
+def add_subscription(inst: driver_khawasu.driver.LogicalDriver, subscription_id, address: str, action_name: str,
+                     handler):
+    """ What LogicalDriver.subscribe does with its answer: updates of subscription_id go to handler """
+    inst.subscribes[int(subscription_id)] = driver_khawasu.driver.Subscribe(address, action_name, handler)
+
+
+def is_healthy(inst: driver_khawasu.driver.LogicalDriver) -> bool:
+    handle = getattr(inst, "socket_thread_handle", None)
+    return handle is None or handle.is_alive()
+
+
+def close(inst: driver_khawasu.driver.LogicalDriver):
+    try:
+        inst.sock.close()
+    except OSError as ex:
+        log.warning("Error in driver close: %r", ex)
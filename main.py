@@ -1,35 +1,79 @@
 import config
 from flask import Flask
+from flask import Blueprint
 from flask import request
 from flask import render_template
 from flask import redirect
 from flask import jsonify
+from flask import g
+from flask import Response
+import cProfile
+import hmac
+import logging
+import os
+import random
+import time
 import urllib
 import json
-import traceback
 
+from common import runtime
+from common.action_queue import action_queue
+from common.auth import login_required, parse_bearer
 from common.device import Device
-from common.khawasu import driver
+from common.metrics import metrics
+from common.ratelimit import login_limiter
+from common.response import encode_json_value, raw_json_response
 from common.token import Token
 from common.user import User, check_login
 
-app = Flask(__name__)
+api = Blueprint('api', __name__)
+
+log = logging.getLogger(__name__)
+
+request_seconds = metrics().histogram("http_request_seconds", "Duration of API requests", ("method", "route"))
+requests_total = metrics().counter("http_requests_total", "API responses by status", ("method", "route", "status"))
+
+
+@api.before_request
+def before_request():
+    g.request_start = time.perf_counter()
+
+    if config.PROFILE_SAMPLE_RATE > 0 and random.random() < config.PROFILE_SAMPLE_RATE:
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+@api.after_request
+def after_request(response):
+    route = request.url_rule.rule if request.url_rule is not None else "unknown"
+
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.disable()
+        os.makedirs(config.PROFILE_DIR, exist_ok=True)
+        file_name = f"{time.time():.3f}-{os.getpid()}-{request.endpoint}.prof"
+        profiler.dump_stats(os.path.join(config.PROFILE_DIR, file_name))
+
+    request_seconds.observe(time.perf_counter() - g.request_start, request.method, route)
+    requests_total.inc(request.method, route, str(response.status_code))
+
+    return response
 
 
 # Just placeholder for root
-@app.route('/')
+@api.route('/')
 def root():
     return "Your smart home is ready."
 
 
 # Script must response 200 OK on this request
-@app.route('/v1.0', methods=['GET', 'POST'])
+@api.route('/v1.0', methods=['GET', 'POST'])
 def main_v10():
     return "OK"
 
 
 # OAuth entry point
-@app.route('/auth/', methods=['GET', 'POST'])
+@api.route('/auth/', methods=['GET', 'POST'])
 def auth():
     try:
         if request.method == 'GET':
@@ -44,31 +88,39 @@ def auth():
 
                 if "username" in request.form:
                     request.user_id = request.form['username']
-                print("invalid auth request")
+                log.info("Invalid auth request")
                 return "Invalid request", 400
 
+            attempt_keys = (f"user:{request.form['username']}", f"addr:{request.remote_addr}")
+            if login_limiter().is_limited(*attempt_keys):
+                log.warning("Too many login attempts", extra={"remote_addr": request.remote_addr})
+                return "Too many login attempts", 429
+
             # Check login and password
             user = User.get_by_username(request.form["username"])
-            if user is None or not check_login(user, request.form["password"]):
-                print("invalid password")
+            if not check_login(user, request.form["password"]):
+                login_limiter().add_failure(*attempt_keys)
+                log.info("Invalid password", extra={"username": request.form["username"]})
                 return render_template('login.html', login_failed=True)
 
+            login_limiter().reset(attempt_keys[0])
+
             # Generate random code and remember this user and time
             token = Token.generate(user.username, Token.TOKEN_CODE_DEFAULT_LENGTH, request.args['state'])
             params = {'state': request.args['state'],
                       'code': token.value,
                       'client_id': config.CLIENT_ID}
 
-            print("code generated")
+            log.info("Code generated", extra={"username": user.username})
 
             return redirect(request.args["redirect_uri"] + '?' + urllib.parse.urlencode(params))
     except Exception as ex:
-        print(traceback.format_exc())
+        log.exception("Error in %s", request.path)
         return f"Error {type(ex).__name__}: {str(ex)}", 500
 
 
 # OAuth, token request
-@app.route('/token/', methods=['POST'])
+@api.route('/token/', methods=['POST'])
 def token():
     try:
         if ("client_secret" not in request.form
@@ -76,19 +128,19 @@ def token():
                 or "client_id" not in request.form
                 or request.form["client_id"] != config.CLIENT_ID
                 or "code" not in request.form):
-            print("invalid token request")
+            log.info("Invalid token request")
             return "Invalid request", 400
 
         token = Token.get_by_value(request.form["code"])
 
         # Check code
         if token is None:
-            print("invalid code")
+            log.info("Invalid code")
             return "Invalid code", 403
 
         # Check time
         if token.check_expired():
-            print("code is too old")
+            log.info("Code is too old")
             return "Code is too old", 403
 
         # Generate and save random token with username
@@ -97,129 +149,150 @@ def token():
         # Revoke code token
         token.revoke()
 
-        print("access granted")
+        log.info("Access granted", extra={"username": token.username})
 
         # Return just token without any expiration time
         return jsonify({'access_token': access_token.value})
     except Exception as ex:
-        print(traceback.format_exc())
+        log.exception("Error in %s", request.path)
         return f"Error {type(ex).__name__}: {str(ex)}", 500
 
 
-# Function to retrieve token from header
-def get_token():
-    auth = request.headers.get('Authorization')
-    if auth is None:
-        return None
-
-    parts = auth.split(' ', 2)
-    if len(parts) == 2 and parts[0].lower() == 'bearer':
-        return parts[1]
-    else:
-        print(f"invalid token: {auth}")
-        return None
-
-
 # Method to revoke token
-@app.route('/v1.0/user/unlink', methods=['POST'])
+@api.route('/v1.0/user/unlink', methods=['POST'])
+@login_required(require_user=False)
 def unlink():
     try:
-        access_token = Token.get_by_value(get_token())
-        if access_token is None:
-            return f"Error: Token not exists", 403
-
+        access_token = g.access_token
         access_token.revoke()
-        print(f"token {access_token} revoked", access_token)
+        log.info("Token revoked", extra={"username": access_token.username})
 
         return jsonify({'request_id': request.headers.get('X-Request-Id')})
     except Exception as ex:
-        print(traceback.format_exc())
+        log.exception("Error in %s", request.path)
         return f"Error {type(ex).__name__}: {str(ex)}", 500
 
 
 # Devices list
-@app.route('/v1.0/user/devices', methods=['GET'])
+@api.route('/v1.0/user/devices', methods=['GET'])
+@login_required()
 def devices_list():
     try:
-        access_token = Token.get_by_value(get_token())
-        if access_token is None:
-            return f"Error: Token not exists", 403
-
         request_id = request.headers.get('X-Request-Id')
+        user = g.user
 
-        # Load user info
-        user = User.get_by_username(access_token.username)
-        if user is None:
-            return f"Error: User not exists", 403
+        devices, etag = Device.get_all_serialized(user.username)
 
-        # todo: add user devices
-        result = {'request_id': request_id,
-                  'payload': {'user_id': user.username, 'devices': [dev.get_row_object() for dev in Device.get_all()]}}
+        # Device array is already encoded, only request_id and user_id are added per request
+        result = b''.join([b'{"request_id":', encode_json_value(request_id),
+                           b',"payload":{"user_id":', encode_json_value(user.username),
+                           b',"devices":', devices, b'}}'])
 
-        return jsonify(result)
+        return raw_json_response(result, etag)
     except Exception as ex:
-        print(traceback.format_exc())
+        log.exception("Error in %s", request.path)
         return f"Error {type(ex).__name__}: {str(ex)}", 500
 
 
 # Method to query current device status
-@app.route('/v1.0/user/devices/query', methods=['POST'])
+@api.route('/v1.0/user/devices/query', methods=['POST'])
+@login_required()
 def query():
     try:
-        access_token = Token.get_by_value(get_token())
-        if access_token is None:
-            return f"Error: Token not exists", 403
-
-        # Load user info
-        user = User.get_by_username(access_token.username)
-        if user is None:
-            return f"Error: User not exists", 403
-
         request_id = request.headers.get('X-Request-Id')
         r = request.get_json()
 
-        result = {'request_id': request_id, 'payload': {'devices': []}}
+        result = {'request_id': request_id,
+                  'payload': {'devices': Device.query_many([device['id'] for device in r["devices"]], g.user.username)}}
 
-        for device in r["devices"]:
-            device_obj = Device.get_by_id(device['id'])
+        return jsonify(result)
+    except Exception as ex:
+        log.exception("Error in %s", request.path)
+        return f"Error {type(ex).__name__}: {str(ex)}", 500
+
+
+# Method to execute some action with devices
+@api.route('/v1.0/user/devices/action', methods=['POST'])
+@login_required()
+def action():
+    try:
+        request_id = request.headers.get('X-Request-Id')
+        r = request.get_json()
 
-            if device_obj is None:
-                continue
+        if config.ACTION_ASYNC_MODE:
+            devices = action_queue().submit_many(g.user.username, r["payload"]["devices"])
+        else:
+            devices = Device.action_many(r["payload"]["devices"], g.user.username)
 
-            result['payload']['devices'].append(device_obj.query())
+        result = {'request_id': request_id, 'payload': {'devices': devices}}
 
         return jsonify(result)
     except Exception as ex:
-        print(traceback.format_exc())
+        log.exception("Error in %s", request.path)
         return f"Error {type(ex).__name__}: {str(ex)}", 500
 
 
-# Method to execute some action with devices
-@app.route('/v1.0/user/devices/action', methods=['POST'])
-def action():
+# Rooms (Khawasu groups) and addresses of their devices, not a part of the Yandex API
+@api.route('/v1.0/user/rooms', methods=['GET'])
+@login_required()
+def rooms_list():
     try:
-        access_token = Token.get_by_value(get_token())
-        if access_token is None:
-            return f"Error: Token not exists", 403
+        return jsonify({'request_id': request.headers.get('X-Request-Id'),
+                        'payload': {'rooms': Device.get_rooms(g.user.username)}})
+    except Exception as ex:
+        log.exception("Error in %s", request.path)
+        return f"Error {type(ex).__name__}: {str(ex)}", 500
 
-        # Load user info
-        user = User.get_by_username(access_token.username)
-        if user is None:
-            return f"Error: User not exists", 403
 
+# Scene execution: {"room": ..., "type": optional Yandex device type, "capabilities": [...]}
+# is sent to every device of the room supporting the capabilities at once
+@api.route('/v1.0/user/rooms/action', methods=['POST'])
+@login_required()
+def room_action():
+    try:
         request_id = request.headers.get('X-Request-Id')
         r = request.get_json()
 
-        result = {'request_id': request_id, 'payload': {'devices': []}}
-
-        for device in r["payload"]["devices"]:
-            device_obj = Device.get_by_id(device['id'])
-            result['payload']['devices'].append(device_obj.action(device['capabilities']))
+        room, capabilities, device_type = r["room"], r["capabilities"], r.get("type")
+        if config.ACTION_ASYNC_MODE:
+            devices = action_queue().submit_many(g.user.username, Device.plan_room_action(room, capabilities,
+                                                                                          device_type, g.user.username))
+            payload = Device.summarize_action_results(room, devices)
+        else:
+            payload = Device.action_room(room, capabilities, device_type, g.user.username)
 
-        return jsonify(result)
+        return jsonify({'request_id': request_id, 'payload': payload})
     except Exception as ex:
-        print(traceback.format_exc())
+        log.exception("Error in %s", request.path)
         return f"Error {type(ex).__name__}: {str(ex)}", 500
 
 
-app.run(host=config.SERVER_HOST, port=config.SERVER_PORT)
+# Prometheus scrape target
+@api.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    if not config.METRICS_ENABLED or not config.METRICS_TOKEN:
+        return "Metrics are disabled", 404
+
+    value = parse_bearer(request.headers.get('Authorization'))
+    if value is None or not hmac.compare_digest(value.encode(), config.METRICS_TOKEN.encode()):
+        return "Error: Token not exists", 403
+
+    return Response(metrics().render(config.METRICS_DIR), mimetype="text/plain; version=0.0.4")
+
+
+def create_app() -> Flask:
+    """
+        Builds the application and starts this process' background work (discovery refresher).
+        WSGI servers must call it in every worker after fork, see wsgi.py and gunicorn.conf.py.
+    """
+    app = Flask(__name__)
+    app.register_blueprint(api)
+
+    runtime.start()
+
+    return app
+
+
+if __name__ == '__main__':
+    # Development server, use gunicorn with wsgi:app in production
+    create_app().run(host=config.SERVER_HOST, port=config.SERVER_PORT, threaded=True)